@@ -16,16 +16,55 @@ bar monitor
 text monitor
 text update
 
-Logic to parse opi file starts on line 292.
+Logic to parse opi file starts after the place* functions.
+
+The module can also be imported to convert screens without starting a new
+interpreter for each one:
+    convertOpi(text,options) returns the EDL text for OPI text or bytes.
+    convertPath(src,dst,options) converts the file src and writes dst.
+Templates and the color palette are prepared the first time they are used.
 '''
 
+import io
+import sys
 import os.path
-from math import sqrt
+import re
+import json
+import marshal
+import hashlib
+import tempfile
+import tarfile
+import zipfile
+import time
+from time import perf_counter
+import select
+import struct
+import mmap
+import ctypes
+import ctypes.util
+from contextlib import contextmanager,redirect_stdout,nullcontext
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+import xml.etree.ElementTree as ET
 import argparse
+import asyncio
+import urllib.parse
+from collections import OrderedDict,deque
 
 # Path on WEDM server of where files will be stored.
 wedmPath = '/cs/opshome/edm/hlc/spectrometers/'
 
+# Version of the conversion output. Bump this whenever a change to the
+# converter changes the .edl it writes so cached screens are rebuilt.
+converterVersion = '11'
+
+# Name of the file in the output directory that records which screens have
+# already been converted, for skipping unchanged screens on later runs.
+manifestName = '.opi2edl_manifest.json'
+
+# Options that change how screens are read but not the EDL written, so they
+# are left out of the manifest.
+readOptions = ('mmap','irCache')
+
 #Base properties for EDM screen.
 edlScreenProps = ['4 0 1','beginScreenProperties','major 4','minor 0',\
     'release 1','x 0','y 0','w WIDTH','h HEIGHT',\
@@ -35,35 +74,517 @@ edlScreenProps = ['4 0 1','beginScreenProperties','major 4','minor 0',\
     'ctlBgColor1 index 34','ctlBgColor2 index 35','topShadowColor index 37',\
     'botShadowColor index 44','snapToGrid','gridSize 5','endScreenProperties\n']
 
-# Function parses line form OPI file for parameter set by "prop".
-# "prop" must be a string.                                                 --->
-def returnProp(item,prop):
-    startText = '<'+prop+'>'
-    endText = '</'+prop+'>'
-    val = [s for s in item if startText in s][0][[s for s in item if \
-        startText in s][0].find(startText)+len(startText):][:[s for s in \
-        item if startText in s][0][[s for s in item if startText in \
-        s][0].find(startText)+len(startText):].find(endText)]
-    return val
+#Properties for EDM Graphics. Upper-case words are slots filled in when a
+#widget is rendered. FILL, ORIENTATION, X_POINTS and Y_POINTS fill whole lines
+#and may be left empty.
+#Static text (aka labels)
+edlStaticTextFmt = ['# (Static Text)','object activeXTextClass',\
+    'beginObjectProperties','major 4','minor 1','release 1','x X_POS',\
+    'y Y_POS','w WIDTH','h HEIGHT','font "helvetica-bold-r-14.0"',\
+    'fontAlign "center"','fgColor index 14','bgColor index 0','useDisplayBg',\
+    'value {','  "LABEL_TEXT"','}','autoSize','endObjectProperties\n']
+
+#lines
+edlLineFmt = ['# (Lines)','object activeLineClass','beginObjectProperties',\
+    'major 4','minor 0','release 1','x X_POS','y Y_POS','w WIDTH','h HEIGHT',\
+    'lineColor index COLOR','fillColor index 51','lineWidth LINE_WEIGHT',\
+    'numPoints NUM_PTS','xPoints {','X_POINTS','}','yPoints {',\
+    'Y_POINTS','}','endObjectProperties\n']
+
+#circles (or ellipses)
+edlCircleFmt = ['# (Circle)','object activeCircleClass',\
+    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
+    'y Y_POS','w WIDTH','h HEIGHT','lineColor index 14','FILL',\
+    'fillColor index COLOR','endObjectProperties\n']
+
+#Rectangles
+edlRectangleFmt = ['# (Rectangle)','object activeRectangleClass',\
+    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
+    'y Y_POS','w WIDTH','h HEIGHT','lineColor index 14','FILL',\
+    'fillColor index COLOR','endObjectProperties\n']
+
+#Gif Images
+edlGifFmt = ['# (GIF Image)','object cfcf6c8a_dbeb_11d2_8a97_00104b8742df',\
+    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
+    'y Y_POS','w WIDTH','h HEIGHT','file "PATH_TO_PIC"','endObjectProperties\n']
+
+#PNG images
+edlPngFmt = ['# (PNG Image)','object activePngClass',\
+    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
+    'y Y_POS','w WIDTH','h HEIGHT','file "PATH_TO_PIC"','endObjectProperties\n']
+
+#Bar monitors - if rotated 90 deg, can act as liquid level indicators
+edlBarMonFmt = ['# (Bar)','object activeBarClass','beginObjectProperties',\
+    'major 4','minor 1','release 1','x X_POS','y Y_POS','w WIDTH','h HEIGHT',\
+    'indicatorColor index COLOR','fgColor index 14','bgColor index 9',\
+    'indicatorPv "PV_NAME"','showScale','origin "0"',\
+    'font "helvetica-medium-r-8.0"','border','precision "10"','min "MIN"',\
+    'max "MAX"','scaleFormat "FFloat"','ORIENTATION','endObjectProperties\n']
+
+#Text update - the standard text indicator
+edlTextUpdateFmt = ['# (Textupdate)','object TextupdateClass',\
+    'beginObjectProperties','major 10','minor 0','release 0','x X_POS',\
+    'y Y_POS','w WIDTH','h HEIGHT','controlPv "PV_NAME"',\
+    'fgColor index 14','fgAlarm','bgColor index 51','fill',\
+    'font "helvetica-medium-r-14.0"','endObjectProperties\n']
+
+### Statistics collected with --stats.
+
+# Stage timings and widget counters for the current process, or None when
+# statistics are off. The hooks only check "stats is not None", so they cost
+# next to nothing when disabled.
+stats = None
+
+# Conversion stages, in the order they are reported. In a serial batch, .opi
+# files are read ahead on a thread (see prefetchedJobs), so "read" is the time
+# spent waiting for them.
+statStages = ('read','split','props','color','render','write')
+
+def newStats():
+    return {'stages':dict.fromkeys(statStages,0.0),'widgets':{},\
+        'unsupported':[],'files':0,'points':[0,0]}
+
+#Adds the time since "start" to a stage and returns the current time.
+def addStage(stage,start):
+    now = perf_counter()
+    stats['stages'][stage] += now-start
+    return now
+
+#Counts one widget of type wType placed in the time since "start".
+def countWidget(wType,start,supported):
+    entry = stats['widgets'].setdefault(wType,[0,0.0])
+    entry[0] += 1
+    entry[1] += perf_counter()-start
+    if not supported and wType not in stats['unsupported']:
+        stats['unsupported'].append(wType)
+
+#Adds the statistics in "part" to "total".
+def mergeStats(total,part):
+    for stage,seconds in part['stages'].items():
+        total['stages'][stage] += seconds
+    for wType,(count,seconds) in part['widgets'].items():
+        entry = total['widgets'].setdefault(wType,[0,0.0])
+        entry[0] += count
+        entry[1] += seconds
+    for wType in part['unsupported']:
+        if wType not in total['unsupported']:
+            total['unsupported'].append(wType)
+    total['files'] += part['files']
+    total['points'][0] += part['points'][0]
+    total['points'][1] += part['points'][1]
+
+#Wraps a file object so time spent in read() or write() is added to "stage".
+class TimedStream(object):
+    def __init__(self,stream,stage):
+        self.stream = stream
+        self.stage = stage
+
+    def read(self,size=-1):
+        start = perf_counter()
+        data = self.stream.read(size)
+        addStage(self.stage,start)
+        return data
+
+    def write(self,text):
+        start = perf_counter()
+        self.stream.write(text)
+        addStage(self.stage,start)
+
+    def flush(self):
+        start = perf_counter()
+        self.stream.flush()
+        addStage(self.stage,start)
+
+#Wraps readOpi's generator so the time spent splitting the XML into widgets,
+#apart from reading the file and indexing properties, is added to "split".
+def timedWidgets(widgets):
+    while True:
+        start = perf_counter()
+        before = stats['stages']['read']+stats['stages']['props']
+        widget = next(widgets,None)
+        addStage('split',start)
+        stats['stages']['split'] -= \
+            stats['stages']['read']+stats['stages']['props']-before
+        if widget is None:
+            return
+        yield widget
+
+#Prints the statistics of a batch that took "seconds" of wall time.
+def printStats(total,seconds):
+    nWidgets = sum([c for c,t in total['widgets'].values()])
+    print('\nConversion statistics:')
+    for stage in statStages:
+        print('  %-8s %9.3f s' % (stage,total['stages'][stage]))
+    print('  %d files, %d widgets in %.3f s: %.1f files/s, %.1f widgets/s' % \
+        (total['files'],nWidgets,seconds,total['files']/max(seconds,1e-9),\
+        nWidgets/max(seconds,1e-9)))
+    if total['points'][0]:
+        print('  %d polyline points in, %d out' % tuple(total['points']))
+    print('  %-20s %8s %9s' % ('widget type','count','time (s)'))
+    for wType,(count,t) in sorted(total['widgets'].items(),\
+        key=lambda item: str(item[0])):
+        mark = ' *' if wType in total['unsupported'] else ''
+        print('  %-20s %8d %9.3f' % (str(wType)+mark,count,t))
+    if total['unsupported']:
+        print('  * conversion not supported, widgets skipped')
+
+# Builds the property index of one OPI element from its direct children
+# (tag -> value). Colors nested in a property such as <background_color> are
+# stored as an (r,g,b) tuple under the parent tag and <point> elements are
+# collected under "points". Child widgets are skipped and only the first
+# occurrence of a tag is kept.
+def indexElement(elem):
+    if stats is not None:  start = perf_counter()
+    index = {}
+    for child in elem:
+        tag = child.tag
+        if tag == 'widget' or tag in index:
+            continue
+        if tag == 'points':
+            index[tag] = [(p.get('x'),p.get('y')) for p in child.iter('point')]
+            continue
+        color = child.find('color')
+        if color is not None:
+            index[tag] = (int(color.get('red')),int(color.get('green')),\
+                int(color.get('blue')))
+        else:
+            index[tag] = child.text or ''
+    if stats is not None:  addStage('props',start)
+    return index
+
+# One widget read from an OPI file. The type name is interned and the geometry
+# kept as ints (None where the file has no value), so screens held in memory
+# share type names and carry no number strings; the remaining properties are
+# in "props", the index built by indexElement, which get() looks up.
+class Widget(object):
+    __slots__ = ('wType','x','y','width','height','props')
+
+    def __init__(self,wType,x,y,width,height,props):
+        self.wType = wType
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.props = props
+
+    def get(self,prop,default=None):
+        return self.props.get(prop,default)
+
+#Returns property "prop" removed from a property index as an int, or None if
+#it is missing or not a number.
+def intProp(index,prop):
+    try:
+        return int(index.pop(prop,None))
+    except (TypeError,ValueError):
+        return None
+
+#Returns the Widget record of a property index built by indexElement.
+def widgetRecord(index):
+    wType = index.pop('widget_type',None)
+    if wType is not None:  wType = sys.intern(wType)
+    return Widget(wType,intProp(index,'x'),intProp(index,'y'),\
+        intProp(index,'width'),intProp(index,'height'),index)
+
+# Streams an OPI file (path or file object) with incremental XML events.
+# The first item yielded is the Widget record of the display itself, then one
+# record per widget. Widgets inside Grouping Containers are flattened into
+# the same stream by flattenGroup, with screen coordinates. Each top-level
+# widget is cleared from the tree once it has been handed out, so memory does
+# not grow with the size of the screen.
+def readOpi(source):
+    depth = 0
+    root = None
+    screen = None
+    # Child widgets of each widget element still open, innermost last. A
+    # container's x/y may come after its children in the file, so a top-level
+    # group is handed out only once it has been read completely.
+    groups = []
+    for event,elem in ET.iterparse(source,events=('start','end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+            elif elem.tag == 'widget':
+                if depth == 2 and screen is None:
+                    # Display properties are written before the widgets.
+                    screen = widgetRecord(indexElement(root))
+                    yield screen
+                groups.append([])
+        else:
+            depth -= 1
+            if depth >= 1 and elem.tag == 'widget':
+                node = (widgetRecord(indexElement(elem)),groups.pop())
+                elem.clear()
+                if groups:
+                    groups[-1].append(node)
+                else:
+                    for widget in flattenGroup(node):
+                        yield widget
+                    root.clear()
+    if screen is None and root is not None:
+        yield widgetRecord(indexElement(root))
+
+# Yields the widgets of a (Widget, child nodes) tree in z-order: each
+# container comes before its children, which are drawn over it, and children
+# keep their order in the file. Child coordinates are relative to their
+# container, so each container's x/y is added to its children's, and to the
+# points of child polylines. Containers themselves are not yielded. An
+# explicit stack keeps this linear in the number of widgets however deep the
+# nesting.
+def flattenGroup(node):
+    stack = [(node,0,0)]
+    while stack:
+        (widget,children),xOffset,yOffset = stack.pop()
+        if xOffset or yOffset:
+            widget.x = (widget.x or 0)+xOffset
+            widget.y = (widget.y or 0)+yOffset
+            if 'points' in widget.props:
+                widget.props['points'] = offsetPoints(widget.props['points'],\
+                    xOffset,yOffset)
+        if children or widget.wType == 'Grouping Container':
+            xOffset = widget.x or 0
+            yOffset = widget.y or 0
+            stack.extend([(child,xOffset,yOffset) for child in \
+                reversed(children)])
+        else:
+            yield widget
+
+#Returns polyline points, as read by indexElement, moved by xOffset/yOffset.
+#Points that are not whole numbers are left as they are.
+def offsetPoints(points,xOffset,yOffset):
+    moved = []
+    for x,y in points:
+        try:
+            moved.append((str(int(x)+xOffset),str(int(y)+yOffset)))
+        except (TypeError,ValueError):
+            moved.append((x,y))
+    return moved
+
+### Memory-mapped reading, used with --mmap.
+
+# The encoding in an XML declaration, and the name of the root element.
+mappedEncoding = re.compile(b'^(?:\\xef\\xbb\\xbf)?<\\?xml[^>]*'\
+    b'encoding=["\']([^"\']*)')
+mappedRoot = re.compile(b'<([^\\s/>?!]+)')
+
+# Bytes that may follow a tag name, so "<widget" does not match <widget_type>.
+tagEnds = frozenset(b' \t\r\n/>')
+
+#Returns the position of the first "name" tag (b'<tag') in data[start:end],
+#or -1 if there is none.
+def findTag(data,name,start,end):
+    while True:
+        pos = data.find(name,start,end)
+        if pos < 0:
+            return -1
+        after = pos+len(name)
+        if after < end and data[after] in tagEnds:
+            return pos
+        start = after
+
+#Yields (position, kind, end) for each widget tag in data from "start" on:
+#kind 1 for <widget ...>, 0 for <widget .../> and -1 for </widget>. Comments
+#and CDATA sections are skipped. The next match of each kind is kept and
+#comments are only looked for between tags, so the file is searched about
+#once however the tags are laid out.
+def widgetTags(data,start):
+    size = len(data)
+    opening = findTag(data,b'<widget',start,size)
+    closing = data.find(b'</widget>',start)
+    while opening >= 0 or closing >= 0:
+        tag = closing if opening < 0 or 0 <= closing < opening else opening
+        bang = data.find(b'<!',start,tag)
+        if bang >= 0:
+            end = data.find(b']]>' if data[bang:bang+9] == b'<![CDATA[' \
+                else b'-->',bang)
+            if end < 0:
+                raise ET.ParseError('unclosed comment at byte '+str(bang))
+            start = end+3
+            if 0 <= opening < start:
+                opening = findTag(data,b'<widget',start,size)
+            if 0 <= closing < start:
+                closing = data.find(b'</widget>',start)
+        elif tag == opening:
+            start = data.find(b'>',opening)+1
+            yield opening,0 if data[start-2] == 0x2f else 1,start
+            opening = findTag(data,b'<widget',start,size)
+        else:
+            start = closing+9
+            yield closing,-1,start
+            closing = data.find(b'</widget>',start)
+
+#Maps an OPI file into memory for reading by byte searches. Returns the map,
+#the position of the first widget tag (-1 if there is none) and the bytes
+#before it, or None for files that have to be parsed instead: empty files,
+#files with a DTD or comments before the first widget, and files not encoded
+#in UTF-8.
+def mapOpi(path):
+    with open(path,'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+    if hasattr(mmap,'MADV_SEQUENTIAL'):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    size = len(data)
+    pos = findTag(data,b'<widget',0,size)
+    header = data[:pos if pos >= 0 else size]
+    encoding = mappedEncoding.match(header)
+    if b'<!' in header or (encoding and encoding.group(1).lower() not in \
+        (b'utf-8',b'utf8',b'us-ascii',b'ascii')):
+        data.close()
+        return None
+    return data,pos,header
+
+#Yields (start, end, nested) for each top-level widget in mapped OPI data,
+#from the first widget tag at "pos": the byte range of the whole element and
+#whether it has widgets inside it.
+def topWidgets(data,pos):
+    depth = 0
+    for tag,kind,end in widgetTags(data,pos):
+        if depth == 0:
+            start,nested = tag,False
+        elif kind >= 0:
+            nested = True
+        depth += kind
+        if depth < 0:
+            raise ET.ParseError('unexpected </widget> at byte '+str(tag))
+        if depth == 0:
+            yield start,end,nested
+    if depth > 0:
+        raise ET.ParseError('unclosed widget at byte '+str(start))
+
+#Reads an OPI file like readOpi, but from a memory map of the file. Widget
+#boundaries are found with byte searches and each top-level widget is parsed
+#on its own straight from a memoryview of the map, so the file is never read
+#into Python bytes and the XML events of properties are not handled one by one
+#in Python. Output is the same as readOpi's. Files mapOpi will not map are
+#handed to readOpi.
+def readOpiMapped(path):
+    mapped = mapOpi(path)
+    if mapped is None:
+        for widget in readOpi(path):
+            yield widget
+        return
+    data,pos,header = mapped
+
+    view = memoryview(data)
+    try:
+        if pos < 0:
+            yield widgetRecord(indexElement(ET.fromstring(header)))
+            return
+        # Display properties are written before the widgets.
+        root = mappedRoot.search(header).group(1)
+        yield widgetRecord(indexElement(ET.fromstring(header+b'</'+root+\
+            b'>')))
+
+        for start,end,nested in topWidgets(data,pos):
+            # The slice is released even if the widget fails to parse, so
+            # the map can be closed.
+            with view[start:end] as widget:
+                if nested:
+                    # Groups are flattened by readOpi.
+                    widgets = readOpi(io.BytesIO(b'<display>'+\
+                        widget.tobytes()+b'</display>'))
+                    next(widgets)
+                else:
+                    # As in readOpi, an empty Grouping Container is dropped.
+                    widgets = flattenGroup((widgetRecord(indexElement(\
+                        ET.fromstring(widget))),[]))
+            for widget in widgets:
+                yield widget
+    finally:
+        try:
+            view.release()
+        finally:
+            data.close()
+
+# Returns property "prop" from a Widget (or property index), or "default" if
+# the widget does not have that property. "prop" must be a string.
+def returnProp(item,prop,default=None):
+    return item.get(prop,default)
+
+# Slots that may appear in a template line, and slots that fill a whole
+# template line. A whole-line slot's value carries its own line endings so it
+# can be left empty.
+slotPattern = re.compile('X_POS|Y_POS|WIDTH|HEIGHT|COLOR|PV_NAME|MAX|MIN|'\
+    'LINE_WEIGHT|LABEL_TEXT|NUM_PTS|PATH_TO_PIC')
+lineSlots = ('FILL','ORIENTATION','X_POINTS','Y_POINTS')
+
+# Compiled form of each template, filled on first use.
+compiledTemplates = {}
+
+#Compiles a template (list of EDL lines) into one format string with a named
+#field per slot, so a widget is rendered by a single format_map call.
+def compileTemplate(template):
+    entry = compiledTemplates.get(id(template))
+    if entry is None or entry[0] is not template:
+        fmt = []
+        for line in template:
+            if line in lineSlots:
+                fmt.append('{'+line+'}')
+            else:
+                line = line.replace('{','{{').replace('}','}}')
+                fmt.append(slotPattern.sub(lambda m: '{'+m.group()+'}',line))
+                fmt.append('\n')
+        entry = (template,''.join(fmt))
+        compiledTemplates[id(template)] = entry
+    return entry[1]
 
 #All widgets have x,y-position and width and height properties.
-#This function just simplifies later code by consolidating common properties
-#into one command.
-def edlPlaceWidget(props,template):
-    edlFmt = []
-    xPos,yPos,width,height = props[1:]
-    for line in template:
-        line = line.replace('X_POS',str(xPos))
-        line = line.replace('Y_POS',str(yPos))
-        line = line.replace('WIDTH',str(width))
-        line = line.replace('HEIGHT',str(height))
-        edlFmt.append(line)
-    return edlFmt
+#This function renders a template with those properties plus any other slot
+#values in "fields" and returns the EDL text for the widget. Geometry missing
+#from the OPI file is written as 0.
+def edlPlaceWidget(widget,template,fields=None):
+    if stats is not None:  start = perf_counter()
+    values = {'X_POS':widget.x or 0,'Y_POS':widget.y or 0,\
+        'WIDTH':widget.width or 0,'HEIGHT':widget.height or 0,'FILL':'',\
+        'ORIENTATION':''}
+    if fields:  values.update(fields)
+    text = compileTemplate(template).format_map(values)
+    if stats is not None:  addStage('render',start)
+    return text
+
+# Names of the files in each directory looked in for images, so a batch lists
+# each directory once however many screens and images refer to it.
+imageDirs = {}
+# (width,height) of each image probed, or None if it could not be read.
+imageSizes = {}
+
+#Returns True if the file "path" exists, checked against the cached listing of
+#its directory rather than with a stat per image.
+def imageExists(path):
+    directory,name = os.path.split(os.path.abspath(path))
+    names = imageDirs.get(directory)
+    if names is None:
+        try:
+            names = set([e.name for e in os.scandir(directory) if e.is_file()])
+        except OSError:
+            names = set()
+        imageDirs[directory] = names
+    return name in names
+
+#Returns the (width,height) of a PNG or GIF image, read from the header bytes
+#only, or None if the file cannot be read or is neither.
+def imageSize(path):
+    if path not in imageSizes:
+        size = None
+        try:
+            with open(path,'rb') as f:
+                head = f.read(24)
+        except OSError:
+            head = b''
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            size = struct.unpack('>II',head[16:24])
+        elif head[:6] in (b'GIF87a',b'GIF89a') and len(head) >= 10:
+            size = struct.unpack('<HH',head[6:10])
+        imageSizes[path] = size
+    return imageSizes[path]
 
 #Checks working directory for image. This command isn't really necessary, but
 #during intial development, I thought it seemed necessary.
 def lookForImage(image):
-    if os.path.isfile(image):
+    if imageExists(image):
         imageFile = image
     else:
         print('"'+image+'" not found.')
@@ -73,32 +594,96 @@ conversion.')
     return imageFile
 
 #Function parses OPI line widget to pull coordinates of line segments and then
-#formats them into the EDL format.
-def ptsGet(widget,lineFmt):
-    pts = [[],[]]
-    opiPts = [line for line in widget if '<point x="' in line]
-    ptFmt = '  N PT'
-    count = 0
-    for p,pt in enumerate(opiPts):
-        x = ptFmt.replace('N',str(p))
-        x = x.replace('PT',str(pt.split('"')[1]))
-        y = ptFmt.replace('N',str(p))
-        y = y.replace('PT',str(pt.split('"')[3]))
-        pts[0].append(x)
-        pts[1].append(y)
-        count += 1
-    ptFmt = lineFmt[: -6]
-    midPtFmt = lineFmt[-5: -3]
-    postPtFmt = lineFmt[-2:]
-    for pt in pts[0]:
-        ptFmt.append(pt)
-    for item in midPtFmt:
-        ptFmt.append(item)
-    for pt in pts[1]:
-        ptFmt.append(pt)
-    for item in postPtFmt:
-        ptFmt.append(item)
-    return ptFmt,str(count)
+#formats them into the EDL format. Returns the xPoints and yPoints lines and
+#the number of points. With a "tolerance", the points are simplified first by
+#simplifyPoints.
+def ptsGet(widget,tolerance=None):
+    opiPts = returnProp(widget,'points',[])
+    if stats is not None:  stats['points'][0] += len(opiPts)
+    if tolerance is not None and len(opiPts) > 2:
+        opiPts = simplifyPoints(opiPts,tolerance)
+    if stats is not None:  stats['points'][1] += len(opiPts)
+    xPts = ''.join(['  '+str(p)+' '+pt[0]+'\n' for p,pt in enumerate(opiPts)])
+    yPts = ''.join(['  '+str(p)+' '+pt[1]+'\n' for p,pt in enumerate(opiPts)])
+    return xPts,yPts,str(len(opiPts))
+
+#Returns the points of a polyline without the ones that move the line by no
+#more than "tolerance" pixels (Ramer-Douglas-Peucker, measuring the distance
+#of each point to the segment that would replace it). A tolerance of 0 removes
+#only repeated points and points in the middle of a straight run, so the line
+#drawn is exactly the same.
+def simplifyPoints(points,tolerance):
+    xs = [float(x) for x,y in points]
+    ys = [float(y) for x,y in points]
+    if tolerance <= 0:
+        keep = exactPoints(xs,ys)
+    else:
+        keep = [False]*len(points)
+        keep[0] = keep[-1] = True
+        limit = tolerance*tolerance
+        # NumPy only pays off on long segments, so short ones use plain lists.
+        numpy = loadNumpy() if len(points) > 64 else None
+        if numpy is not None:
+            xArray,yArray = numpy.array(xs),numpy.array(ys)
+        segments = [(0,len(points)-1)]
+        while segments:
+            first,last = segments.pop()
+            if last-first < 2:
+                continue
+            if numpy is not None and last-first > 64:
+                dist = segmentDistances(numpy,xArray,yArray,first,last)
+                i = int(dist.argmax())
+                farthest = float(dist[i])
+            else:
+                dist = segmentDistances(None,xs,ys,first,last)
+                farthest = max(dist)
+                i = dist.index(farthest)
+            if farthest > limit:
+                i += first+1
+                keep[i] = True
+                segments.append((first,i))
+                segments.append((i,last))
+    return [p for p,k in zip(points,keep) if k]
+
+#Returns the squared distances of the points between "first" and "last" to
+#the segment joining them, as a NumPy array or, without "numpy", a list.
+def segmentDistances(numpy,xs,ys,first,last):
+    x0,y0 = xs[first],ys[first]
+    dx,dy = xs[last]-x0,ys[last]-y0
+    length = dx*dx+dy*dy
+    if numpy is not None:
+        px,py = xs[first+1:last]-x0,ys[first+1:last]-y0
+        if length == 0:
+            return px*px+py*py
+        t = numpy.clip((px*dx+py*dy)/length,0.0,1.0)
+        return (px-t*dx)**2+(py-t*dy)**2
+    dist = []
+    for i in range(first+1,last):
+        px,py = xs[i]-x0,ys[i]-y0
+        t = 0.0 if length == 0 else min(max((px*dx+py*dy)/length,0.0),1.0)
+        dist.append((px-t*dx)**2+(py-t*dy)**2)
+    return dist
+
+#Returns which points to keep so that repeated points, and points lying on
+#the straight line between their neighbours, are dropped.
+def exactPoints(xs,ys):
+    kept = []
+    for i in range(len(xs)):
+        if kept and xs[kept[-1]] == xs[i] and ys[kept[-1]] == ys[i]:
+            continue
+        while len(kept) >= 2:
+            a,b = kept[-2],kept[-1]
+            abx,aby = xs[b]-xs[a],ys[b]-ys[a]
+            bcx,bcy = xs[i]-xs[b],ys[i]-ys[b]
+            # b is dropped only if the line carries on in the same direction.
+            if abx*bcy-aby*bcx != 0 or abx*bcx+aby*bcy <= 0:
+                break
+            kept.pop()
+        kept.append(i)
+    keep = [False]*len(xs)
+    for i in kept:
+        keep[i] = True
+    return keep
 
 # colorList are acceptable colors as RGB codes for WEDM.
 # Index of list element corresponds to EDM color pallet index for WEDM.
@@ -135,167 +720,1285 @@ colorsList = [['255','255','255'],['235','235','235'],['218','218','218'],\
     ['255','150','168'],['192','113','126'],['184','46','0']]
 
 
+# colorsList compiled into integer (r,g,b) tuples, and into a NumPy array for
+# nearestColors. Both are built on first use.
+palette = None
+paletteArray = None
+
+# Nearest palette index for every RGB color matched so far.
+colorMatches = {}
+
+# NumPy module once imported, or False if it is not installed. NumPy is only
+# imported when a batch of colors is first matched.
+numpyModule = None
+
+def loadNumpy():
+    global numpyModule
+    if numpyModule is None:
+        try:
+            import numpy
+            numpyModule = numpy
+        except ImportError:
+            numpyModule = False
+    return numpyModule or None
+
+def compiledPalette():
+    global palette
+    if palette is None:
+        palette = [(int(r),int(g),int(b)) for r,g,b in colorsList]
+    return palette
+
+#Returns the index of the palette color closest to rgb, an (r,g,b) tuple of
+#ints. Squared distance picks the same color as the square-rooted distance,
+#and ties go to the lowest index.
+def nearestColor(rgb):
+    match = colorMatches.get(rgb)
+    if match is None:
+        r2,g2,b2 = rgb
+        dMatch = 99999*99999
+        for index,(r1,g1,b1) in enumerate(compiledPalette()):
+            d = (r2-r1)*(r2-r1) + (g2-g1)*(g2-g1) + (b2-b1)*(b2-b1)
+            if d < dMatch:
+                dMatch = d
+                match = index
+        colorMatches[rgb] = match
+    return match
+
+#Batch version of nearestColor for every color in a screen at once. Uses NumPy
+#when it is installed. Results are stored in the same cache nearestColor reads.
+def nearestColors(colors):
+    global paletteArray
+    missing = list(set(c for c in colors if c not in colorMatches))
+    numpy = loadNumpy() if missing else None
+    if numpy is not None:
+        if paletteArray is None:
+            paletteArray = numpy.array(compiledPalette(),dtype=numpy.int32)
+        diff = numpy.array(missing,dtype=numpy.int32)[:,None,:]-paletteArray
+        matches = (diff*diff).sum(axis=2).argmin(axis=1)
+        colorMatches.update(zip(missing,matches.tolist()))
+    return [nearestColor(c) for c in colors]
+
+# Background color of CSS widgets that do not set one.
+defaultBackground = (240,240,240)
+
 #Looks to see whether widget has transparent components and then looks at
-#RGB color of widget and finds which EDM color is closest.
+#RGB color of widget and finds which EDM color is closest. Matching always
+#uses colorsList; colorConst is kept for existing callers. A widget without a
+#background color gets the closest color to defaultBackground.
 def convertColor(colorConst,widget):
-    #try-except for widgets that do not have transparent property.
-    try:
-        transparent = returnProp(widget,'transparent')
-    except:
-        transparent = 'false'
-    for e,line in enumerate(widget):
-        if '<background_color>' in line and '</background_color>' \
-        in widget[e+2]:
-            origColor = widget[e+1].split('"')[1::2]
-            dMatch = 99999
-            match = 9999
-            for index,color in enumerate(colorsList):
-                r1,g1,b1 = color
-                r2,g2,b2 = origColor
-                d = sqrt((int(r2)-int(r1))**2 + (int(g2)-int(g1))**2 + \
-                    (int(b2)-int(b1))**2)
-                if d < dMatch:
-                    dMatch = d
-                    match = index
-    outColor = str(match)
+    if stats is not None:  start = perf_counter()
+    transparent = returnProp(widget,'transparent','false')
+    origColor = returnProp(widget,'background_color')
+    if origColor is None:
+        print('NOTICE: "'+str(returnProp(widget,'name',widget.wType))+\
+            '" has no background color. Default background used.')
+        origColor = defaultBackground
+    outColor = str(nearestColor(origColor))
+    if stats is not None:  addStage('color',start)
     return outColor,transparent
 
 
 ### All functions defined after this point place EDM widgets on screens based
-### on properties parsed from CSS file.
+### on properties parsed from CSS file. Each one writes the rendered widget to
+### "out", a writable text stream, using the conversion "options".
 
 #Static text (aka labels)
-def placeStaticText(widget,props,final):
-    edlStaticTextFmt = ['# (Static Text)','object activeXTextClass',\
-    'beginObjectProperties','major 4','minor 1','release 1','x X_POS',\
-    'y Y_POS','w WIDTH','h HEIGHT','font "helvetica-bold-r-14.0"',\
-    'fontAlign "center"','fgColor index 14','bgColor index 0','useDisplayBg',\
-    'value {','  "LABEL_TEXT"','}','autoSize','endObjectProperties\n']
-    fmt = edlPlaceWidget(props,edlStaticTextFmt)
-    for row in fmt:
-        row = row.replace('LABEL_TEXT',returnProp(widget,'text'))
-        final.append(row)
-    return final
+def placeStaticText(widget,out,options):
+    out.write(edlPlaceWidget(widget,edlStaticTextFmt,\
+        {'LABEL_TEXT':returnProp(widget,'text','')}))
 
 # Lines
-def placeLine(widget,props,final):
-    edlLineFmt = ['# (Lines)','object activeLineClass','beginObjectProperties',\
-    'major 4','minor 0','release 1','x X_POS','y Y_POS','w WIDTH','h HEIGHT',\
-    'lineColor index COLOR','fillColor index 51','lineWidth LINE_WEIGHT',\
-    'numPoints NUM_PTS','xPoints {','X_POINTS','}','yPoints {',\
-    'Y_POINTS','}','endObjectProperties\n']
-    pts,nPts = ptsGet(widget,edlLineFmt)
-    fmt = edlPlaceWidget(props,pts)
+def placeLine(widget,out,options):
+    tolerance = options.get('simplify')
+    if tolerance is not None:  tolerance = float(tolerance)
+    xPts,yPts,nPts = ptsGet(widget,tolerance)
     outColor,transparent = convertColor(colorsList,widget)
-    for row in fmt:
-        row = row.replace('COLOR',outColor)
-        row = row.replace('NUM_PTS',nPts)
-        row = row.replace('LINE_WEIGHT',returnProp(widget,\
-            'line_width'))
-        final.append(row)
-    return final
+    out.write(edlPlaceWidget(widget,edlLineFmt,{'COLOR':outColor,\
+        'NUM_PTS':nPts,'X_POINTS':xPts,'Y_POINTS':yPts,\
+        'LINE_WEIGHT':returnProp(widget,'line_width','1')}))
 
 #circles (or ellipses)
-def placeCirlce(widget,props,final):
-    edlCircleFmt = ['# (Circle)','object activeCircleClass',\
-    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
-    'y Y_POS','w WIDTH','h HEIGHT','lineColor index 14',\
-    'fillColor index COLOR','endObjectProperties\n']
-    fmt = edlPlaceWidget(props,edlCircleFmt)
+def placeCircle(widget,out,options):
     outColor,transparent = convertColor(colorsList,widget)
-    for row in fmt:
-        if 'fillColor' in row and transparent == 'false':
-            final.append('fill')
-        row = row.replace('COLOR',outColor)
-        final.append(row)
-    return final
+    out.write(edlPlaceWidget(widget,edlCircleFmt,{'COLOR':outColor,\
+        'FILL':'fill\n' if transparent == 'false' else ''}))
 
 #Rectangles
-def placeRectangle(widget,props,final):
-    edlRectangleFmt = ['# (Rectangle)','object activeRectangleClass',\
-    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
-    'y Y_POS','w WIDTH','h HEIGHT','lineColor index 14',\
-    'fillColor index COLOR','endObjectProperties\n']
-    fmt = edlPlaceWidget(props,edlRectangleFmt)
+def placeRectangle(widget,out,options):
     outColor,transparent = convertColor(colorsList,widget)
-    for r,row in enumerate(fmt):
-        if 'fillColor' in row and transparent == 'false':
-            final.append('fill')
-        row = row.replace('COLOR',outColor)
-        final.append(row)
-    return final
-
-def placeImage(widget,props,final):
-    edlGifFmt = ['# (GIF Image)','object cfcf6c8a_dbeb_11d2_8a97_00104b8742df',\
-    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
-    'y Y_POS','w WIDTH','h HEIGHT','file "PATH_TO_PIC"','endObjectProperties\n']
-    edlPngFmt = ['# (PNG Image)','object activePngClass',\
-    'beginObjectProperties','major 4','minor 0','release 0','x X_POS',\
-    'y Y_POS','w WIDTH','h HEIGHT','file "PATH_TO_PIC"','endObjectProperties\n']
-    imageFile = returnProp(widget,'image_file')
+    out.write(edlPlaceWidget(widget,edlRectangleFmt,{'COLOR':outColor,\
+        'FILL':'fill\n' if transparent == 'false' else ''}))
+
+def placeImage(widget,out,options):
+    imageFile = returnProp(widget,'image_file','')
+    if imageFile and options['sourceDir'] is not None:
+        # The image is looked for relative to the screen, and its header gives
+        # the size of widgets that have none.
+        options['images'].add(imageFile)
+        path = os.path.normpath(os.path.join(options['sourceDir'],imageFile))
+        if lookForImage(path) != 'NOT_FOUND':
+            if not widget.width or not widget.height:
+                size = imageSize(path)
+                if size is not None:
+                    widget.width = widget.width or size[0]
+                    widget.height = widget.height or size[1]
     if imageFile[-4:].lower() == '.png':
-        fmt = edlPlaceWidget(props,edlPngFmt)
-        conv = True
+        out.write(edlPlaceWidget(widget,edlPngFmt,\
+            {'PATH_TO_PIC':options['wedmPath']+imageFile}))
     elif imageFile[-4:].lower() == '.gif':
-        fmt = edlPlaceWidget(props,edlGifFmt)
-        conv = True
+        out.write(edlPlaceWidget(widget,edlGifFmt,\
+            {'PATH_TO_PIC':options['wedmPath']+imageFile}))
     else:
         print('NOTICE: File type of image in OPI not supported in EDM.')
         print('Image will not be converted to EDL.')
-        conv = False
-    if conv:
-        for row in fmt:
-            row = row.replace('PATH_TO_PIC',wedmPath+imageFile)
-            final.append(row)
-    else:
-        final = final
-    return final
 
 #Bar monitors - if rotated 90 deg, can act as liquid level indicators
-def placeBarMon(widget,props,final):
-    edlBarMonFmt = ['# (Bar)','object activeBarClass','beginObjectProperties',\
-    'major 4','minor 1','release 1','x X_POS','y Y_POS','w WIDTH','h HEIGHT',\
-    'indicatorColor indexCOLOR','fgColor index 14','bgColor index 9',\
-    'indicatorPv "PV_NAME"','showScale','origin "0"',\
-    'font "helvetica-medium-r-8.0"','border','precision "10"','min "MIN"',\
-    'max "MAX"','scaleFormat "FFloat"','endObjectProperties\n']
-    fmt = edlPlaceWidget(props,edlBarMonFmt)
+def placeBarMon(widget,out,options):
     outColor,transparent = convertColor(colorsList,widget)
+    orientation = returnProp(widget,'horizontal','false')
+    out.write(edlPlaceWidget(widget,edlBarMonFmt,{'COLOR':outColor,\
+        'PV_NAME':returnProp(widget,'pv_name',''),\
+        'MAX':returnProp(widget,'maximum','100'),\
+        'MIN':returnProp(widget,'minimum','0'),\
+        'ORIENTATION':'orientation "vertical"\n' if orientation == 'false' \
+        else ''}))
+
+def placeTextUpdate(widget,out,options):
+    out.write(edlPlaceWidget(widget,edlTextUpdateFmt,\
+        {'PV_NAME':returnProp(widget,'pv_name','')}))
+
+
+# Widget types placed by convertStream. Linking Containers are replaced by the
+# widgets of the screen they show; any other type is not supported.
+supportedTypes = frozenset(['Text Update','Label','Image','Polyline',\
+    'Rectangle','Rounded Rectangle','Ellipse','Progress Bar','Tank',\
+    'Linking Container'])
+
+### Functions after this point run conversions of whole files.
+
+#Creates .edl file name by removing opi file extension and appending .edl.
+def edlName(opi):
+    return opi[opi.rfind('/')+1:][:opi[opi.rfind('/')+1:].find('.opi')]+'.edl'
+
+#Returns the SHA-256 of a file's contents, read in blocks.
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1<<16),b''):
+            h.update(block)
+    return h.hexdigest()
+
+#Returns whether the files "a" and "b" have the same contents. Sizes are
+#compared first, so files are only hashed when they could be equal.
+def sameFile(a,b):
     try:
-        orientation = returnProp(widget,'horizontal')
-    except:
-        orientation = 'false'
-    for row in fmt:
-        row = row.replace('PV_NAME',returnProp(widget,'pv_name'))
-        row = row.replace('MAX',returnProp(widget,'maximum'))
-        row = row.replace('MIN',returnProp(widget,'minimum'))
-        if 'endObjectProperties' in row and orientation == 'false':
-            final.append('orientation "vertical"')
-        final.append(row)
-    return final
-
-def placeTextUpdate(widget,props,final):
-    edlTextUpdateFmt = ['# (Textupdate)','object TextupdateClass',\
-    'beginObjectProperties','major 10','minor 0','release 0','x X_POS',\
-    'y Y_POS','w WIDTH','h HEIGHT','controlPv "PV_NAME"',\
-    'fgColor index 14','fgAlarm','bgColor index 51','fill',\
-    'font "helvetica-medium-r-14.0"','endObjectProperties\n']
-    fmt = edlPlaceWidget(props,edlTextUpdateFmt)
-    for row in fmt:
-        row = row.replace('PV_NAME',returnProp(widget,'pv_name'))
-        final.append(row)
-    return final
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+        return fileHash(a) == fileHash(b)
+    except OSError:
+        return False
+
+#Removes the .edl files in outputPath of screens in the manifest that were in
+#"directory" and whose .opi file no longer exists, along with their manifest
+#entries. Screens from other directories sharing outputPath are left alone.
+#An .edl file that a screen still in the manifest converts to is kept.
+#Returns the number of files removed.
+def removeStale(manifest,outputPath,directory):
+    directory = os.path.abspath(directory)
+    gone = [(opi,manifest.pop(opi).get('edl')) for opi in sorted(manifest) \
+        if os.path.dirname(opi) == directory and not os.path.exists(opi)]
+    keep = set([entry.get('edl') for entry in manifest.values()])
+    removed = 0
+    for opi,edl in gone:
+        if edl is None or edl in keep:
+            continue
+        try:
+            os.remove(outputPath+edl)
+        except OSError:
+            continue
+        print(outputPath+edl+' removed, its source '+opi+' no longer exists.')
+        removed += 1
+    return removed
+
+#Reads the rebuild manifest from an output directory. A missing or unreadable
+#manifest is treated as empty, so every screen is converted.
+def loadManifest(outputPath):
+    try:
+        with open(outputPath+manifestName,'r') as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+#Writes the rebuild manifest.
+def saveManifest(outputPath,manifest):
+    with atomicWriter(outputPath+manifestName) as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+
+#Opens a buffered text stream for writing an .edl file. Output goes to a
+#temporary file in the same directory, which is renamed over "path" only once
+#everything has been written, so a partially written .edl is never visible.
+#If writing fails the temporary file is removed and "path" is left as it was.
+#If what was written is the same as the existing file, the temporary file is
+#removed too and "path" is not touched, so its modification time stays and
+#caches downstream stay valid. If "info" is given, info['written'] is set to
+#whether "path" was replaced. With "binary", the stream takes bytes instead of
+#text.
+@contextmanager
+def atomicWriter(path,binary=False,info=None):
+    with tempWriter(path,binary) as (f,tmp):
+        yield f
+    written = replaceFile(tmp,path)
+    if info is not None:  info['written'] = written
+
+#Opens the temporary file for "path" used by atomicWriter and yields the
+#stream and the temporary file's path. The file is removed if writing fails;
+#otherwise it is left for replaceFile.
+@contextmanager
+def tempWriter(path,binary=False):
+    directory,name = os.path.split(path)
+    fd,tmp = tempfile.mkstemp(prefix='.'+name+'.',suffix='.tmp',\
+        dir=directory or '.')
+    try:
+        with os.fdopen(fd,'wb' if binary else 'w',buffering=1<<16) as f:
+            yield f,tmp
+    except BaseException:
+        removeFile(tmp)
+        raise
+
+#Moves the finished temporary file "tmp" over "path", keeping the mode of the
+#file it replaces, unless the two are the same; then "tmp" is removed and
+#"path" is not touched. Returns whether "path" was replaced.
+def replaceFile(tmp,path):
+    try:
+        written = not sameFile(tmp,path)
+        if written:
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            os.chmod(tmp,mode)
+            os.replace(tmp,path)
+        else:
+            os.unlink(tmp)
+    except BaseException:
+        removeFile(tmp)
+        raise
+    return written
+
+#Removes a file if it is there.
+def removeFile(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+# Sub-screens of Linking Containers already read: the absolute path of each
+# .opi file -> (its widgets with their own links inlined, the files it links
+# to). A sub-screen used by many screens in a batch is parsed only once.
+# One cut short because it links back to a screen it was inlined into is not
+# kept, since it would look different included anywhere else.
+linkedScreens = {}
+
+#Empties the caches of directory listings, image sizes and sub-screens, so
+#files changed since they were filled are read again.
+def clearCaches():
+    imageDirs.clear()
+    imageSizes.clear()
+    linkedScreens.clear()
+
+#Passes on the widgets of a screen in "directory", replacing each Linking
+#Container by the widgets of the .opi file it shows, offset, along with the
+#points of polylines, by the container's x/y. Image paths of linked widgets
+#are made relative to "directory". "chain" holds the files the screen is being
+#inlined into, so a screen that links back to one of them is skipped instead
+#of recursing forever. Every linked file is added to the set "links", and
+#every one skipped for linking back is added to the set "cuts".
+def linkedWidgets(widgets,directory,chain,links,cuts=None):
+    for widget in widgets:
+        if widget.wType != 'Linking Container':
+            yield widget
+            continue
+        opiFile = widget.get('opi_file')
+        if not opiFile:
+            continue
+        path = os.path.normpath(os.path.join(directory,opiFile))
+        if path in chain:
+            print('NOTICE: "'+path+'" links back to itself. Link skipped.')
+            if cuts is not None:  cuts.add(path)
+            continue
+        if not os.path.isfile(path):
+            print('"'+path+'" not found. Link skipped.')
+            continue
+        linked = linkedScreens.get(path)
+        if linked is None:
+            subLinks,subCuts = set(),set()
+            subWidgets = readOpi(path)
+            next(subWidgets)
+            linked = (list(linkedWidgets(subWidgets,os.path.dirname(path),\
+                chain+(path,),subLinks,subCuts)),subLinks)
+            # Links back to this screen are cut wherever it is included;
+            # links back to the screens including it are not.
+            subCuts.discard(path)
+            if subCuts:
+                if cuts is not None:  cuts |= subCuts
+            else:
+                linkedScreens[path] = linked
+        links.add(path)
+        links |= linked[1]
+        subDir = os.path.dirname(path)
+        xOffset = widget.x or 0
+        yOffset = widget.y or 0
+        for sub in linked[0]:
+            # Copies share the cached property index unless an image path
+            # or polyline points have to change.
+            props = sub.props
+            image = props.get('image_file')
+            if image and subDir != directory and not os.path.isabs(image):
+                props = dict(props,image_file=os.path.relpath(\
+                    os.path.join(subDir,image),directory))
+            if 'points' in props and (xOffset or yOffset):
+                props = dict(props,points=offsetPoints(props['points'],\
+                    xOffset,yOffset))
+            yield Widget(sub.wType,(sub.x or 0)+xOffset,\
+                (sub.y or 0)+yOffset,sub.width,sub.height,props)
+
+# Compression of tar bundles, by file name ending.
+tarCompression = {'.tar.gz':'gz','.tgz':'gz','.tar.bz2':'bz2','.tar.xz':'xz'}
+
+#Opens a bundle archive at "path" for writing: a zip file if the name ends in
+#.zip, otherwise a tar file, compressed according to tarCompression. Yields a
+#function add(name,text) that appends one file to the archive. Members are
+#streamed into the archive as they are added, and the archive only replaces
+#"path" once it is complete.
+@contextmanager
+def bundleWriter(path):
+    with atomicWriter(path,binary=True) as f:
+        if path.lower().endswith('.zip'):
+            archive = zipfile.ZipFile(f,'w',zipfile.ZIP_DEFLATED)
+            def add(name,text):
+                member = zipfile.ZipInfo(name,time.localtime()[:6])
+                member.compress_type = zipfile.ZIP_DEFLATED
+                member.external_attr = 0o644<<16
+                archive.writestr(member,text.encode('utf-8'))
+        else:
+            compression = ''
+            for ending,method in tarCompression.items():
+                if path.lower().endswith(ending):  compression = method
+            archive = tarfile.open(fileobj=f,mode='w|'+compression)
+            def add(name,text):
+                data = text.encode('utf-8')
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                member.mtime = time.time()
+                member.mode = 0o644
+                archive.addfile(member,io.BytesIO(data))
+        with archive:
+            yield add
+
+#Returns the path of the IR cache file for the .opi file "opi" in the cache
+#directory "irCache". Files are named by a hash of the screen's directory and
+#contents: the linked screens inlined in an IR, and image paths, depend on
+#where the screen is, so the same screen in two directories has two IRs.
+#"digest" is the hash of the contents if they have already been read.
+def irName(irCache,opi,digest=None):
+    h = hashlib.sha256(os.path.dirname(os.path.abspath(opi)).encode('utf-8'))
+    h.update((digest or fileHash(opi)).encode('ascii'))
+    return os.path.join(irCache,h.hexdigest()+'.ir')
+
+#Loads a screen's intermediate representation (IR): the display and every
+#widget after groups are flattened and linked screens inlined, as Widget
+#fields, saved by saveIr. Returns (screen, widgets, links), or None if there
+#is no usable IR: it is missing or unreadable, was saved by another converter
+#version, or a linked screen has changed since.
+def loadIr(path):
+    try:
+        with open(path,'rb') as f:
+            ir = marshal.load(f)
+        if ir['version'] != converterVersion:
+            return None
+    except (OSError,EOFError,ValueError,TypeError,KeyError):
+        return None
+    for link,linkHash in ir['links'].items():
+        if not os.path.isfile(link) or fileHash(link) != linkHash:
+            return None
+    return Widget(*ir['screen']),[Widget(*w) for w in ir['widgets']],\
+        set(ir['links'])
+
+#Saves a screen's IR (see loadIr). "widgets" are the fields of each Widget as
+#it was read, before rendering changed anything.
+def saveIr(path,screen,widgets,links):
+    ir = {'version':converterVersion,'screen':screen,'widgets':widgets,\
+        'links':dict([(link,fileHash(link)) for link in links])}
+    with atomicWriter(path,binary=True) as f:
+        f.write(marshal.dumps(ir))
+
+#Passes on widgets, adding the fields of each one to the list "records".
+def recordedWidgets(widgets,records):
+    for widget in widgets:
+        records.append((widget.wType,widget.x,widget.y,widget.width,\
+            widget.height,widget.props))
+        yield widget
+
+#Returns the conversion options: the defaults with any given in "options"
+#applied on top.
+def conversionOptions(options=None):
+    merged = {'wedmPath':wedmPath}
+    if options:  merged.update(options)
+    return merged
+
+#Converts the OPI screen read from "source" (path or binary file object; the
+#"name" of a file object is taken as its path if it names a file, which
+#stdin's '<stdin>' does not) and writes the EDL to "out" as each widget is
+#rendered. Returns the set of widget types that could not be converted. If
+#"info" is given, the sets of images the screen uses and of .opi files it
+#links to are stored in it as 'images' and 'links'. With the 'flush' option,
+#"out" is flushed after every widget, so a reader at the other end of a pipe
+#can start on the EDL straight away.
+def convertStream(source,out,options,info=None):
+    unable = []
+    opened = None
+    # Images and linked screens are looked for relative to the screen's
+    # directory, which for a stream can be given as the 'sourceDir' option.
+    sourceDir = options.get('sourceDir')
+    chain = ()
+    path = source
+    if hasattr(source,'read'):
+        path = getattr(source,'name',None)
+        if not isinstance(path,str) or not os.path.isfile(path):
+            path = None
+    if path is not None:
+        sourceDir = os.path.dirname(os.path.abspath(path))
+        chain = (os.path.abspath(path),)
+    if info is None:  info = {}
+    info['images'],info['links'] = set(),set()
+    options = dict(options,sourceDir=sourceDir,images=info['images'])
+    mapped = options.get('mmap') and not hasattr(source,'read')
+    # With an IR cache, a screen read before is rendered from its IR without
+    # reading the XML; otherwise the IR is recorded as the screen is read.
+    irPath,ir,records = None,None,None
+    if options.get('irCache') and path is not None:
+        # A screen read ahead into memory is hashed from there.
+        digest = None
+        if isinstance(source,io.BytesIO):
+            digest = hashlib.sha256(source.getbuffer()).hexdigest()
+        irPath = irName(options['irCache'],path,digest)
+        ir = loadIr(irPath)
+    if stats is not None:
+        # Reads and writes are timed through wrappers around the streams.
+        if not mapped and ir is None:
+            if not hasattr(source,'read'):
+                source = opened = open(source,'rb')
+            source = TimedStream(source,'read')
+        out = TimedStream(out,'write')
+    try:
+        if ir is not None:
+            screen,widgets,links = ir
+            info['links'] |= links
+            widgets = iter(widgets)
+        else:
+            # Streams widgets out of the .opi file one at a time.
+            widgets = readOpiMapped(source) if mapped else readOpi(source)
+            if stats is not None:  widgets = timedWidgets(widgets)
+
+            # dimensions of screen.
+            screen = next(widgets)
+            screen.x,screen.y = 0,0
+            if screen.width is None:  screen.width = 800
+            if screen.height is None:  screen.height = 600
+            widgets = linkedWidgets(widgets,sourceDir or '.',chain,\
+                info['links'])
+            if irPath is not None:
+                records = []
+                widgets = recordedWidgets(widgets,records)
+        out.write(edlPlaceWidget(screen,edlScreenProps))
+        flush = options.get('flush')
+        if flush:  out.flush()
+
+        # Processes OPI widgets to determine widget type and other properties.
+        for widget in widgets:
+            if stats is not None:  start = perf_counter()
+            wType = widget.wType
+            supported = True
+            if wType == 'Text Update':
+                placeTextUpdate(widget,out,options)
+            elif wType == 'Label':
+                placeStaticText(widget,out,options)
+            elif wType == 'Image':
+                placeImage(widget,out,options)
+            elif wType == 'Polyline':
+                placeLine(widget,out,options)
+            elif wType == 'Rectangle' or wType == 'Rounded Rectangle':
+                placeRectangle(widget,out,options)
+            elif wType == 'Ellipse':
+                placeCircle(widget,out,options)
+            elif wType == 'Progress Bar' or wType == 'Tank':
+                placeBarMon(widget,out,options)
+            else:
+                unable.append(wType)
+                supported = False
+            if flush and supported:  out.flush()
+            if stats is not None:  countWidget(wType,start,supported)
+    finally:
+        if opened is not None:  opened.close()
+    if records is not None:
+        saveIr(irPath,(screen.wType,screen.x,screen.y,screen.width,\
+            screen.height,screen.props),records,info['links'])
+    if stats is not None:  stats['files'] += 1
+    return set(unable)
+
+#Converts OPI text (str or bytes) and returns the EDL text. "options" is a
+#dict of conversion options, e.g. {'wedmPath':'/cs/opshome/edm/'}.
+def convertOpi(source,options=None):
+    if isinstance(source,str):
+        source = source.encode('utf-8')
+    out = io.StringIO()
+    convertStream(io.BytesIO(source),out,conversionOptions(options))
+    return out.getvalue()
+
+#Converts the .opi file at "src" and writes the .edl file to "dst". Returns the
+#set of widget types that could not be converted. "info" is filled in as by
+#convertStream and atomicWriter.
+def convertPath(src,dst,options=None,info=None):
+    with atomicWriter(dst,info=info) as out:
+        return convertStream(src,out,conversionOptions(options),info)
+
+#Converts one .opi file to an .edl file written to outputPath, reporting
+#progress on the console. Returns the set of widget types that could not be
+#converted. "info" is filled in as by convertStream. If "out" is given, the
+#EDL is written to that text stream instead, and if "source" is given the
+#screen is read from that binary file object instead of opening opi.
+def convertFile(opi,outputPath,options=None,info=None,out=None,source=None):
+    print('\n'+opi)
+    edl = edlName(opi)
+    if source is None:  source = opi
+    if out is None:
+        unable = convertPath(source,outputPath+edl,options,info)
+    else:
+        unable = convertStream(source,out,conversionOptions(options),info)
+    if unable:
+        print(', '.join(unable)+' conversion not supported. Widgets \
+skipped.')
+    print(opi+' converted to '+edl+'\n')
+    return unable
+
+#Runs convertFile for one file of a batch. Console output is captured so the
+#output of each file can be printed together and in order when files are
+#converted in parallel, and an error in one file is returned instead of
+#stopping the rest of the batch. For a bundle, the EDL text is returned instead
+#of being written. In a serial batch, "data" is a future of the .opi file's
+#contents read ahead, and the finished .edl is handed to "writes", a
+#WriteBehind, to be compared with the old one and put in place.
+#Whether the .edl was written or left unchanged is returned last, None if that
+#is not known yet.
+def convertFileJob(job,data=None,writes=None):
+    global stats
+    opi,outputPath,options,collectStats,bundled = job
+    # Each file gets its own statistics, which are returned for the batch
+    # total.
+    stats = newStats() if collectStats else None
+    log = io.StringIO()
+    unable,error,info = set(),None,{'images':(),'links':(),'written':None}
+    out = io.StringIO() if bundled else None
+    with redirect_stdout(log):
+        try:
+            source = None
+            if data is not None:
+                if stats is not None:  start = perf_counter()
+                source = io.BytesIO(data.result())
+                source.name = opi
+                if stats is not None:  addStage('read',start)
+            if writes is None or bundled:
+                unable = convertFile(opi,outputPath,options,info,out,source)
+            else:
+                # The .edl is streamed to its temporary file as in
+                # convertPath, and only put in place behind.
+                path = outputPath+edlName(opi)
+                with tempWriter(path) as (edl,tmp):
+                    unable = convertFile(opi,outputPath,options,info,edl,\
+                        source)
+                writes.add(opi,tmp,path)
+        except Exception as e:
+            error = type(e).__name__+': '+str(e)
+    fileStats,stats = stats,None
+    return opi,log.getvalue(),unable,error,fileStats,sorted(info['images']),\
+        sorted(info['links']),None if out is None else out.getvalue(),\
+        info['written']
+
+# Threads reading and writing files for a batch, and the most .opi files, and
+# bytes of them, read ahead of the conversion in a serial batch. The same
+# number of finished .edl files may wait to be put in place.
+ioThreads = 4
+readAhead = 8
+readAheadBytes = 64<<20
+
+#Returns the contents of a file.
+def readFile(path):
+    with open(path,'rb') as f:
+        return f.read()
+
+# Puts finished .edl files in place with replaceFile on a thread pool while
+# the next screens are converted, so comparing each with the old file does
+# not hold up the conversion. Once more than "limit" files are waiting, add()
+# waits for the oldest. Files that could not be put in place are collected in
+# "failed" as (opi, error), and files left as they were because nothing
+# changed are counted in "unchanged".
+class WriteBehind(object):
+    def __init__(self,pool,limit):
+        self.pool = pool
+        self.limit = limit
+        self.pending = deque()
+        self.failed = []
+        self.unchanged = 0
+
+    def add(self,opi,tmp,path):
+        self.pending.append((opi,self.pool.submit(replaceFile,tmp,path)))
+        while len(self.pending) > self.limit:
+            self.finish()
+
+    def finish(self):
+        opi,future = self.pending.popleft()
+        error = future.exception()
+        if error is not None:
+            self.failed.append((opi,type(error).__name__+': '+str(error)))
+        elif not future.result():
+            self.unchanged += 1
+
+    def drain(self):
+        while self.pending:
+            self.finish()
+
+#Runs convertFileJob for each job of a serial batch with the .opi files read
+#ahead on "pool", up to readAhead files and readAheadBytes at a time, so the
+#next screens are being fetched while one is converted. Sizes are counted
+#when a read is started; a file larger than readAheadBytes is still read,
+#but alone.
+def prefetchedJobs(todo,pool,writes):
+    ahead,aheadBytes = deque(),0
+    jobs = iter(todo)
+    job = next(jobs,None)
+    while job is not None or ahead:
+        while job is not None and len(ahead) < readAhead:
+            try:
+                size = os.path.getsize(job[0])
+            except OSError:
+                size = 0
+            if ahead and aheadBytes+size > readAheadBytes:
+                break
+            ahead.append((job,pool.submit(readFile,job[0]),size))
+            aheadBytes += size
+            job = next(jobs,None)
+        current,data,size = ahead.popleft()
+        aheadBytes -= size
+        yield convertFileJob(current,data,writes)
+
+
+#Converts a batch of .opi files into outputPath. Screens whose contents,
+#converter version and options match the manifest from the last run, and
+#whose .edl still exists, are skipped unless "force" is set. Files are
+#converted in order, or across a process pool of "jobs" processes; results
+#come back in file order either way. Prints a summary for batches of more
+#than one file. The manifest also lists the images each screen needs deployed
+#with it, and the hashes of the screens it links to, so a screen is converted
+#again when one of those changes. With "collectStats", per-stage timings and
+#widget counts are printed at the end and, if "statsJson" is given, written
+#there as JSON.
+#With a "bundle" archive path, every screen is converted and, instead of
+#writing .edl files, the batch is streamed into that one archive (see
+#bundleWriter) with its manifest. Members are named relative to outputPath,
+#so the archive is extracted in the output directory itself.
+#With a "prune" directory, the .edl files of screens removed from it since
+#they were converted are deleted (see removeStale). Nothing is pruned by a
+#batch with no files, so a directory that is unreachable does not empty the
+#output.
+def runBatch(files,outputPath,options,jobs=1,force=False,collectStats=False,\
+    statsJson=None,bundle=None,prune=None):
+    startTime = perf_counter()
+    total = newStats()
+    # Images and linked screens are looked up afresh for each batch.
+    clearCaches()
+    linkHashes = {}
+    def linkHash(path):
+        if path not in linkHashes:
+            linkHashes[path] = fileHash(path) if os.path.isfile(path) else None
+        return linkHashes[path]
+    manifest = loadManifest(outputPath) if bundle is None else {}
+    buildOptions = dict([(k,v) for k,v in options.items() \
+        if k not in readOptions],output=os.path.abspath(outputPath or '.'))
+    # Files are hashed, and in a serial batch read and written, on a thread
+    # pool, so waiting on a network filesystem overlaps with other work.
+    ioPool = ThreadPoolExecutor(max_workers=ioThreads)
+    hashes = ioPool.map(fileHash,files)
+    todo,entries,skipped = [],{},0
+    for opi,opiHash in zip(files,hashes):
+        entries[opi] = {'hash':opiHash,'version':converterVersion,\
+            'options':buildOptions,'edl':edlName(opi)}
+        last = manifest.get(os.path.abspath(opi),{})
+        if not force and bundle is None and \
+            all([last.get(k) == v for k,v in entries[opi].items()]) and \
+            all([linkHash(p) == h for p,h in last.get('links',{}).items()]) \
+            and os.path.isfile(outputPath+edlName(opi)):
+            skipped += 1
+        else:
+            todo.append((opi,outputPath,options,collectStats,\
+                bundle is not None))
+    if skipped:
+        print('\n'+str(skipped)+' OPI files unchanged since last conversion. \
+Use --force to convert them anyway.')
+
+    pool,writes = None,None
+    if jobs > 1 and len(todo) > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(convertFileJob,todo)
+    elif len(todo) > 1 and not options.get('mmap'):
+        if bundle is None:  writes = WriteBehind(ioPool,readAhead)
+        results = prefetchedJobs(todo,ioPool,writes)
+    else:
+        results = map(convertFileJob,todo)
+
+    converted,failed,unsupported,unchanged,removed = 0,[],set(),0,0
+    with (bundleWriter(bundle) if bundle is not None else nullcontext()) \
+        as add:
+        for opi,log,unable,error,fileStats,images,links,text,written in \
+            results:
+            print(log,end='')
+            if fileStats is not None:  mergeStats(total,fileStats)
+            if error is not None:
+                print('ERROR: '+opi+' could not be converted. '+error+'\n')
+                failed.append(opi)
+            else:
+                converted += 1
+                if written is False:  unchanged += 1
+                unsupported |= unable
+                manifest[os.path.abspath(opi)] = dict(entries[opi],\
+                    images=images,links=dict([(p,linkHash(p)) for p in links]))
+                if text is not None:
+                    add(edlName(opi),text)
+        if pool is not None:
+            pool.shutdown()
+        if writes is not None:
+            writes.drain()
+            for opi,error in writes.failed:
+                print('ERROR: '+opi+' could not be written. '+error+'\n')
+                failed.append(opi)
+                converted -= 1
+                manifest.pop(os.path.abspath(opi),None)
+            unchanged += writes.unchanged
+        ioPool.shutdown()
+        if bundle is not None:
+            add(manifestName,json.dumps(manifest,indent=1,sort_keys=True))
+            print('Bundle of '+str(converted)+' screens written to "'+\
+                bundle+'".')
+        else:
+            if prune is not None and files:
+                removed = removeStale(manifest,outputPath,prune)
+            if todo or removed:
+                saveManifest(outputPath,manifest)
+
+    if len(files) > 1:
+        print(str(converted)+' of '+str(len(files))+' OPI files converted, '\
+            +str(skipped)+' unchanged.')
+        if failed:
+            print(str(len(failed))+' failed: '+', '.join(failed))
+        if unsupported:
+            print('Unsupported widget types skipped: '+\
+                ', '.join(sorted(unsupported)))
+    if bundle is None and files:
+        print('EDL files: '+str(converted-unchanged)+' written, '+\
+            str(unchanged)+' identical and left as they were, '+\
+            str(removed)+' removed.')
+
+    if collectStats:
+        seconds = perf_counter()-startTime
+        printStats(total,seconds)
+        if statsJson:
+            with open(statsJson,'w') as f:
+                json.dump(dict(total,seconds=seconds),f,indent=1,\
+                    sort_keys=True)
+
+# Properties read by a corpus scan, as start tags in the bytes of a widget.
+scanTags = [re.compile(b'<'+tag+b'(?:[ \t\r\n][^>]*)?>') for tag in \
+    (b'widget_type',b'pv_name',b'image_file')]
+# Entity and character references in XML text.
+xmlReference = re.compile('&(#x[0-9a-fA-F]+|#[0-9]+|lt|gt|amp|quot|apos);')
+xmlEntities = {'lt':'<','gt':'>','amp':'&','quot':'"','apos':"'"}
+
+#Returns the text of a reference matched by xmlReference.
+def xmlCharacter(match):
+    name = match.group(1)
+    if name[:2] == '#x':
+        return chr(int(name[2:],16))
+    if name[0] == '#':
+        return chr(int(name[1:]))
+    return xmlEntities[name]
+
+#Returns the text of the property matched by "tag" (one of scanTags) in the
+#bytes of a widget with no widgets or comments inside it, as findtext would,
+#or None if the widget does not have it. Only direct children of the widget
+#count: the tag has to be one level in, going by the tags opened and closed
+#before it.
+def scanProp(widget,tag):
+    match = tag.search(widget)
+    while match is not None:
+        pos = match.start()
+        closing = widget.count(b'</',0,pos)
+        if widget.count(b'<',0,pos)-2*closing-widget.count(b'/>',0,pos) == 1:
+            end = match.end()
+            if widget[end-2:end] == b'/>':
+                return ''
+            text = widget[end:widget.find(b'<',end)].decode('utf-8')
+            if '&' in text:  text = xmlReference.sub(xmlCharacter,text)
+            if '\r' in text:
+                text = text.replace('\r\n','\n').replace('\r','\n')
+            return text
+        match = tag.search(widget,match.end())
+    return None
+
+#Yields (widget_type, pv_name, image_file) of each widget of an .opi file,
+#for a corpus scan. Widgets are those readOpi would hand out, but nothing is
+#parsed beyond finding them: top-level widgets are found in a memory map of
+#the file as by readOpiMapped, and the three properties are read from the
+#bytes of each. Groups, widgets with comments, and files mapOpi will not map
+#are handed to scanParsed. The XML is only checked as far as the widget tags
+#go; other errors in a file are left for conversion to report.
+def scanWidgets(path):
+    mapped = mapOpi(path)
+    if mapped is None:
+        for fields in scanParsed(path):
+            yield fields
+        return
+    data,pos,header = mapped
+    try:
+        if pos < 0:
+            return
+        for start,end,nested in topWidgets(data,pos):
+            widget = data[start:end]
+            if nested or b'<!' in widget:
+                for fields in scanParsed(io.BytesIO(b'<display>'+widget+\
+                    b'</display>')):
+                    yield fields
+                continue
+            wType = scanProp(widget,scanTags[0])
+            if wType != 'Grouping Container':
+                yield wType,scanProp(widget,scanTags[1]),\
+                    scanProp(widget,scanTags[2])
+    finally:
+        data.close()
+
+#Yields what scanWidgets does, from XML events. Only these three properties
+#are looked at: nothing else is indexed, no colors or points are decoded and
+#no Widget records are made.
+def scanParsed(source):
+    root,depth = None,0
+    for event,elem in ET.iterparse(source,events=('start','end')):
+        if elem.tag != 'widget':
+            if root is None:  root = elem
+            continue
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # Containers are flattened away by readOpi.
+        if elem.find('widget') is None:
+            wType = elem.findtext('widget_type')
+            if wType != 'Grouping Container':
+                yield wType,elem.findtext('pv_name'),\
+                    elem.findtext('image_file')
+        if depth == 0:
+            root.clear()
+
+#Reads one .opi file for a corpus scan: widgets are found but nothing is
+#rendered or written (see scanWidgets). Returns the file, a dict of widget
+#counts by type, the PVs and images used, and the error if the file could not
+#be read.
+def scanFileJob(job):
+    opi,options = job
+    counts,pvs,images,error = {},set(),set(),None
+    try:
+        for wType,pv,image in scanWidgets(opi):
+            wType = wType or '(no widget_type)'
+            counts[wType] = counts.get(wType,0)+1
+            if pv:  pvs.add(pv)
+            if image:  images.add(image)
+    except Exception as e:
+        error = type(e).__name__+': '+str(e)
+    return opi,counts,sorted(pvs),sorted(images),error
+
+#Scans a batch of .opi files, across a process pool of "jobs" processes if
+#more than one, and prints a report of the widget types, unsupported types,
+#PVs and images found. If "report" is given, the full report, including the
+#counts of each file, is written there as JSON.
+def runScan(files,options,jobs=1,report=None):
+    startTime = perf_counter()
+    todo = [(opi,options) for opi in files]
+    pool = None
+    if jobs > 1 and len(todo) > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(scanFileJob,todo,chunksize=16)
+    else:
+        results = map(scanFileJob,todo)
+
+    types,unsupported,pvs,images,perFile,failed = {},{},{},{},{},{}
+    for opi,counts,filePvs,fileImages,error in results:
+        if error is not None:
+            failed[opi] = error
+            continue
+        fileUnsupported = sorted([t for t in counts if t not in supportedTypes])
+        perFile[opi] = {'widgets':counts,'unsupported':fileUnsupported,\
+            'pvs':len(filePvs),'images':fileImages}
+        for wType,count in counts.items():
+            types[wType] = types.get(wType,0)+count
+        # Unsupported types, PVs and images are counted by file.
+        for wType in fileUnsupported:
+            unsupported[wType] = unsupported.get(wType,0)+1
+        for pv in filePvs:
+            pvs[pv] = pvs.get(pv,0)+1
+        for image in fileImages:
+            images[image] = images.get(image,0)+1
+    if pool is not None:
+        pool.shutdown()
+    seconds = perf_counter()-startTime
+
+    nWidgets = sum(types.values())
+    print('\nScanned '+str(len(perFile))+' OPI files, '+str(nWidgets)+\
+        ' widgets in %.2f s.' % seconds)
+    print('  %-24s %9s %7s' % ('widget type','widgets','files'))
+    for wType in sorted(types):
+        files = sum([1 for f in perFile.values() if wType in f['widgets']])
+        mark = ' *' if wType in unsupported else ''
+        print('  %-24s %9d %7d' % (wType+mark,types[wType],files))
+    if unsupported:
+        print('  * conversion not supported')
+        print(str(len([f for f in perFile.values() if f['unsupported']]))+\
+            ' files have unsupported widgets.')
+    print(str(len(pvs))+' distinct PVs, '+str(len(images))+\
+        ' distinct images.')
+    if failed:
+        print(str(len(failed))+' failed: '+', '.join(sorted(failed)))
+
+    if report:
+        with open(report,'w') as f:
+            json.dump({'files':perFile,'failed':failed,'widgetTypes':types,\
+                'unsupported':unsupported,'pvs':pvs,'images':images,\
+                'seconds':seconds},f,indent=1,sort_keys=True)
+        print('Scan report written to "'+report+'".')
+
+# inotify event flags: a file written and closed, or renamed into the
+# directory (editors that save through a temporary file).
+inCloseWrite = 0x08
+inMovedTo = 0x80
+
+#Opens an inotify watch on "directory". Returns the inotify file descriptor,
+#or None where inotify is not available.
+def inotifyWatch(directory):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',\
+            use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+    except (OSError,AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd,os.fsencode(directory),\
+        inCloseWrite|inMovedTo) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+#Returns the names of files in the events read from an inotify descriptor.
+def inotifyNames(fd):
+    names = []
+    try:
+        data = os.read(fd,1<<16)
+    except BlockingIOError:
+        return names
+    pos = 0
+    while pos+16 <= len(data):
+        wd,mask,cookie,size = struct.unpack_from('iIII',data,pos)
+        name = data[pos+16:pos+16+size].rstrip(b'\0')
+        names.append(os.fsdecode(name))
+        pos += 16+size
+    return names
+
+#Returns the modification time and size of every .opi file in "directory".
+def opiStats(directory):
+    stats = {}
+    for entry in os.scandir(directory):
+        if entry.name[-4:].lower() == '.opi':
+            try:
+                st = entry.stat()
+                stats[entry.name] = (st.st_mtime_ns,st.st_size)
+            except OSError:
+                pass
+    return stats
+
+#Yields lists of .opi files in "directory" that have changed. Uses inotify
+#when it is available and otherwise polls the directory every "interval"
+#seconds. Changes are collected until no new change has arrived for
+#"debounce" seconds, so a burst of saves yields one list, but never held for
+#longer than "maxDelay" seconds.
+def watchChanges(directory,debounce=0.25,interval=0.5,maxDelay=0.75):
+    fd = inotifyWatch(directory)
+    if fd is None:
+        print('inotify not available, polling for changes.')
+        seen = opiStats(directory)
+    pending,first,last = set(),0,0
+    try:
+        while True:
+            wait = debounce if pending else None
+            if fd is not None:
+                ready = select.select([fd],[],[],wait)[0]
+                names = inotifyNames(fd) if ready else []
+            else:
+                time.sleep(interval if wait is None else min(interval,wait))
+                current = opiStats(directory)
+                names = [n for n in current if seen.get(n) != current[n]]
+                seen = current
+            names = [n for n in names if n[-4:].lower() == '.opi']
+            now = time.monotonic()
+            if names:
+                if not pending:  first = now
+                pending.update(names)
+                last = now
+            if pending and (now-last >= debounce or now-first >= maxDelay):
+                yield sorted(directory+n for n in pending \
+                    if os.path.isfile(directory+n))
+                pending = set()
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+#Returns the screens recorded in the manifest of outputPath that link to any
+#of the .opi files "changed", so they are converted again along with them.
+#Screens in "directory" are named as watchChanges names them.
+def linkingScreens(changed,outputPath,directory):
+    changed = set([os.path.abspath(opi) for opi in changed])
+    screens = []
+    for opi,entry in sorted(loadManifest(outputPath).items()):
+        if changed.isdisjoint(entry.get('links',())) or \
+            not os.path.isfile(opi):
+            continue
+        if os.path.dirname(opi) == os.path.abspath(directory):
+            opi = directory+os.path.basename(opi)
+        screens.append(opi)
+    return screens
+
+
+# Number of converted screens kept in memory by the conversion service.
+serveCacheSize = 256
+
+#Returns the hashes of the files "paths", None for ones that do not exist.
+def linkHashes(paths):
+    return dict([(p,fileHash(p) if os.path.isfile(p) else None) \
+        for p in paths])
+
+#Converts OPI bytes for the conversion service. Returns the EDL and the hashes
+#of the screens it links to, for checking the cached EDL later.
+def serviceConvert(data,options):
+    clearCaches()
+    out,info = io.StringIO(),{}
+    convertStream(io.BytesIO(data),out,conversionOptions(options),info)
+    return out.getvalue(),linkHashes(info['links'])
+
+#Returns the EDL of OPI bytes for the conversion service, reusing the cached
+#EDL when the same content has already been converted with the same options
+#and the screens it links to are unchanged. "cache" is an OrderedDict of
+#(EDL, link hashes) kept in least-recently-used order; it is only used from
+#the event loop's thread. Conversions run on "converter", a single thread, as
+#they share the module's caches.
+async def cachedConvert(data,options,cache,converter):
+    loop = asyncio.get_running_loop()
+    key = (hashlib.sha256(data).hexdigest(),tuple(sorted(options.items())))
+    entry = cache.get(key)
+    if entry is not None:
+        if await loop.run_in_executor(converter,linkHashes,entry[1]) == \
+            entry[1]:
+            if key in cache:  cache.move_to_end(key)
+            return entry[0]
+    entry = await loop.run_in_executor(converter,serviceConvert,data,options)
+    cache[key] = entry
+    cache.move_to_end(key)
+    while len(cache) > serveCacheSize:
+        cache.popitem(last=False)
+    return entry[0]
+
+#Handles one request to the conversion service and returns the HTTP status
+#and response text.
+#    POST /convert             converts the .opi sent as the request body.
+#    GET  /convert?path=FILE   converts the .opi file at FILE, with images and
+#                              linked screens relative to its directory.
+#Other query parameters (e.g. wedmPath) override the service's options.
+async def serveRequest(method,target,body,options,cache,converter):
+    url = urllib.parse.urlsplit(target)
+    query = dict(urllib.parse.parse_qsl(url.query))
+    if url.path != '/convert':
+        return '404 Not Found','Unknown path "'+url.path+'".\n'
+    path = query.pop('path',None)
+    options = dict(options,**query)
+    if method == 'POST':
+        data = body
+    elif method == 'GET' and path is not None:
+        try:
+            with open(path,'rb') as f:
+                data = f.read()
+        except OSError as e:
+            return '404 Not Found',str(e)+'\n'
+        options['sourceDir'] = os.path.dirname(os.path.abspath(path))
+    else:
+        return '400 Bad Request','POST an .opi file or GET with ?path=.\n'
+    try:
+        edl = await cachedConvert(data,options,cache,converter)
+    except Exception as e:
+        return '422 Unprocessable Entity',type(e).__name__+': '+str(e)+'\n'
+    return '200 OK',edl
+
+#Reads HTTP/1.1 requests from one client connection until it is closed.
+async def serveClient(reader,writer,options,cache,converter):
+    try:
+        while True:
+            requestLine = await reader.readline()
+            if not requestLine:
+                break
+            method,target,version = requestLine.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n',b'\n',b''):
+                    break
+                name,value = line.decode('latin-1').split(':',1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(\
+                int(headers.get('content-length','0')))
+            status,text = await serveRequest(method,target,body,options,\
+                cache,converter)
+            payload = text.encode('utf-8')
+            writer.write(('HTTP/1.1 '+status+'\r\n'\
+                'Content-Type: text/plain; charset=utf-8\r\n'\
+                'Content-Length: '+str(len(payload))+'\r\n\r\n')\
+                .encode('latin-1')+payload)
+            await writer.drain()
+            if version == 'HTTP/1.0' or \
+                headers.get('connection','').lower() == 'close':
+                break
+    except (ValueError,asyncio.IncompleteReadError,ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+#Runs the conversion service until interrupted. "address" is HOST:PORT for a
+#TCP port, or the path of a Unix socket.
+async def serve(address,options):
+    cache = OrderedDict()
+    converter = ThreadPoolExecutor(max_workers=1)
+    handler = lambda r,w: serveClient(r,w,options,cache,converter)
+    if '/' in address:
+        server = await asyncio.start_unix_server(handler,path=address)
+    else:
+        host,port = address.rsplit(':',1)
+        server = await asyncio.start_server(handler,host or '127.0.0.1',\
+            int(port))
+    print('Serving conversions on '+address+'. Press Ctrl-C to stop.')
+    async with server:
+        await server.serve_forever()
 
 
 ###############################################################################
 if __name__ == '__main__':
     ### Parses input arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument('opi',help='CSS .OPI file to convert to WEDM.')
+    parser.add_argument('opi',nargs='?',help='CSS .OPI file to convert to \
+    WEDM.')
     parser.add_argument('-o','--output',help='Path of where to write resulting \
     WEDM file to.')
+    parser.add_argument('-j','--jobs',type=int,default=1,help='Number of \
+    processes used to convert a directory of OPI files.')
+    parser.add_argument('-w','--wedm-path',default=wedmPath,help='Path on \
+    the WEDM server where images referenced by the screens are stored.')
+    parser.add_argument('-f','--force',action='store_true',help='Convert \
+    every OPI file, even ones unchanged since the last run.')
+    parser.add_argument('--watch',action='store_true',help='Keep running \
+    and reconvert OPI files in the input directory as they change.')
+    parser.add_argument('--prune',action='store_true',help='Delete the \
+    WEDM files of screens that have been removed from the input directory \
+    since they were converted.')
+    parser.add_argument('--mmap',action='store_true',help='Read OPI files \
+    through a memory map, decoding only the properties used.')
+    parser.add_argument('--ir-cache',metavar='DIR',help='Keep the parsed \
+    screens in DIR, so later runs, with any output options, skip the XML of \
+    screens that have not changed.')
+    parser.add_argument('--simplify',type=float,metavar='TOLERANCE',\
+    help='Drop polyline points that move the line by no more than TOLERANCE \
+    pixels; 0 drops only repeated and collinear points.')
+    parser.add_argument('--bundle',metavar='ARCHIVE',help='Write every \
+    converted screen and the manifest into one .tar, .tar.gz, .tgz, .tar.bz2, \
+    .tar.xz or .zip archive instead of separate files.')
+    parser.add_argument('--scan',nargs='?',const='',metavar='REPORT',\
+    help='Only read the OPI files and report the widget types, unsupported \
+    types, PVs and images they use; with REPORT, also write it as JSON.')
+    parser.add_argument('--stats',action='store_true',help='Report time \
+    spent in each conversion stage and per widget type.')
+    parser.add_argument('--stats-json',metavar='FILE',help='Also write the \
+    --stats report to FILE as JSON.')
+    parser.add_argument('--serve',nargs='?',const='127.0.0.1:8420',\
+    metavar='ADDRESS',help='Run a conversion service on HOST:PORT (default \
+    127.0.0.1:8420) or a Unix socket path instead of converting files.')
     args = parser.parse_args()
 
+    if args.simplify is not None and args.simplify < 0:
+        parser.error('--simplify TOLERANCE must not be negative')
+    options = conversionOptions({'wedmPath':args.wedm_path})
+    if args.simplify is not None:  options['simplify'] = args.simplify
+    if args.mmap:  options['mmap'] = True
+    if args.ir_cache:
+        if not os.path.isdir(args.ir_cache):  os.makedirs(args.ir_cache)
+        options['irCache'] = os.path.abspath(args.ir_cache)
+
+    # Service mode converts screens sent to it until interrupted.
+    if args.serve is not None:
+        try:
+            asyncio.run(serve(args.serve,options))
+        except KeyboardInterrupt:
+            print('')
+        sys.exit(0)
+    if args.opi is None:
+        parser.error('an OPI file or directory is required')
+    collectStats = args.stats or args.stats_json is not None
+
+    # Pipe mode: '-' as the input reads one screen from stdin, and '-' as the
+    # output writes the EDL to stdout. Messages go to stderr instead, so
+    # stdout carries only the EDL.
+    if args.opi == '-' or args.output == '-':
+        if args.opi != '-' and not os.path.isfile(args.opi):
+            parser.error('-o - needs a single OPI file')
+        if args.output not in (None,'-'):
+            parser.error('a screen read from stdin can only be written to \
+stdout')
+        if args.watch or args.bundle or args.scan is not None:
+            parser.error('--watch, --bundle and --scan cannot be used with -')
+        # Unbuffered reads return whatever has arrived, so the widgets sent
+        # so far are converted without waiting for a full block.
+        source = sys.stdin.buffer.raw if args.opi == '-' else args.opi
+        out = sys.stdout
+        with redirect_stdout(sys.stderr):
+            startTime = perf_counter()
+            if collectStats:  stats = newStats()
+            try:
+                unable = convertStream(source,out,dict(options,flush=True))
+            except Exception as e:
+                print('ERROR: OPI screen could not be converted. '+\
+                    type(e).__name__+': '+str(e))
+                sys.exit(1)
+            if unable:
+                print(', '.join(unable)+' conversion not supported. Widgets \
+skipped.')
+            if collectStats:
+                seconds = perf_counter()-startTime
+                printStats(stats,seconds)
+                if args.stats_json:
+                    with open(args.stats_json,'w') as f:
+                        json.dump(dict(stats,seconds=seconds),f,indent=1,\
+                            sort_keys=True)
+        sys.exit(0)
+
     inputArg = args.opi
 
     if args.output != None:
@@ -313,7 +2016,7 @@ if __name__ == '__main__':
     files = []
     if os.path.isdir(inputArg):
         if inputArg[-1] != '/':  inputArg += '/'
-        for f in os.listdir(inputArg):
+        for f in sorted(os.listdir(inputArg)):
             if f[-4:].lower() == '.opi':
                 files.append(inputArg+f)
     else:
@@ -325,68 +2028,35 @@ if __name__ == '__main__':
     else:
         print('\nOPI files entered into script:')
 
-    for opi in files:
-        unable = []
-        print('\n'+opi)
-        # Creates .edl file name by removing opi file extension and
-        # appending .edl.
-        edl = opi[opi.rfind('/')+1:][:opi[opi.rfind('/')+1:].find('.opi')]\
-            +'.edl'
-
-        # Opens .opi file as text and stores all lines as list elements.
-        with open(opi,'r') as f:
-            opiLines = f.readlines()
-
-    # Processes OPI file lines to determine widget type and other properties.
-        final = []
-        # dimensions of screen.
-        width = returnProp(opiLines,'width')
-        height = returnProp(opiLines,'height')
-        for line in edlScreenProps:
-            line = line.replace('WIDTH',width)
-            line = line.replace('HEIGHT',height)
-            final.append(line)
-
-        hold = 0
-        #widget properties
-        for i,line in enumerate(opiLines):
-            #separates opi file into widgets.
-            if '<widget typeId=' in line and hold == 0:
-                hold = i
-            elif '</widget>' in line and hold != 0:
-                widget = opiLines[hold:i+1]
-                hold = 0
-                wType = returnProp(widget,'widget_type')
-                xPos = returnProp(widget,'x')
-                yPos = returnProp(widget,'y')
-                width = returnProp(widget,'width')
-                height = returnProp(widget,'height')
-                props = [wType,xPos,yPos,width,height]
-                if wType == 'Text Update':
-                    final = placeTextUpdate(widget,props,final)
-                elif wType == 'Label':
-                    final = placeStaticText(widget,props,final)
-                elif wType == 'Image':
-                    final = placeImage(widget,props,final)
-                elif wType == 'Polyline':
-                    final = placeLine(widget,props,final)
-                elif wType == 'Rectangle' or wType == 'Rounded Rectangle':
-                    final = placeRectangle(widget,props,final)
-                elif wType == 'Ellipse':
-                    final = placeCircle(widget,props,final)
-                elif wType == 'Progress Bar' or wType == 'Tank':
-                    final = placeBarMon(widget,props,final)
-                else:
-                    unable.append(wType)
-        if unable != []:
-            unable = set(unable)
-            print(', '.join(unable)+' conversion not supported. Widgets \
-skipped.')
+    if args.watch and args.bundle:
+        parser.error('--watch cannot be used with --bundle')
+
+    # Scan mode reports on the screens without converting them.
+    if args.scan is not None:
+        runScan(files,options,args.jobs,args.scan)
+        sys.exit(0)
 
+    prune = None
+    if args.prune:
+        if args.bundle:
+            parser.error('--prune cannot be used with --bundle')
+        if os.path.isdir(inputArg):  prune = inputArg
+    runBatch(files,outputPath,options,args.jobs,args.force,collectStats,\
+        args.stats_json,args.bundle,prune)
 
-        # Writes resulting "final" list to text to .edl file for EDM.
-        with open(outputPath+edl,'w') as f:
-            for line in final:
-                f.write(line)
-                f.write('\n')
-        print(opi+' converted to '+edl+'\n')
+    # Watch mode reconverts changed screens until interrupted.
+    if args.watch:
+        if not os.path.isdir(inputArg):
+            print('--watch needs a directory of OPI files.')
+        else:
+            print('\nWatching "'+inputArg+'" for changes. Press Ctrl-C to \
+stop.')
+            try:
+                for changed in watchChanges(inputArg):
+                    # Screens that include a changed screen change too.
+                    changed = sorted(set(changed+linkingScreens(changed,\
+                        outputPath,inputArg)))
+                    runBatch(changed,outputPath,options,args.jobs,False,\
+                        collectStats,args.stats_json,None,prune)
+            except KeyboardInterrupt:
+                print('')
@@ -0,0 +1,177 @@
+#!/bin/env python
+'''
+Benchmarks for opi2edl.py and opi2edl_v2.py.
+
+Generates a synthetic .opi screen with a configurable number of every
+supported widget type, times the helper functions the converters spend their
+time in and the end-to-end conversion of the screen, and writes the results
+as JSON so runs from different commits can be compared.
+
+python opi2edl_bench.py -n 200 -p 50 -o bench.json
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+
+import opi2edl
+import opi2edl_v2
+
+# Widget types generated for a synthetic screen, with the typeId suffix and
+# extra properties each one needs.
+widgetKinds = [('Label','Label',\
+        '<text>Label NUM</text><transparent>true</transparent>'),\
+    ('Text Update','TextUpdate',\
+        '<pv_name>BENCH:PV:NUM</pv_name><text>######</text>'),\
+    ('Polyline','polyline','<line_width>2</line_width>POINTS'),\
+    ('Rectangle','Rectangle','<transparent>false</transparent>'),\
+    ('Ellipse','Ellipse','<transparent>true</transparent>'),\
+    ('Image','Image','<image_file>images/bench_NUM.png</image_file>'),\
+    ('Progress Bar','progressbar','<pv_name>BENCH:LEVEL:NUM</pv_name>'\
+        '<maximum>100.0</maximum><minimum>0.0</minimum>'\
+        '<horizontal>false</horizontal>'),\
+    ('Tank','tank','<pv_name>BENCH:TANK:NUM</pv_name>'\
+        '<maximum>100.0</maximum><minimum>0.0</minimum>')]
+
+#Returns the OPI text of one widget.
+def makeWidget(wType,typeId,extra,num,points,rand):
+    x,y = rand.randint(0,1900),rand.randint(0,1000)
+    pts = ''
+    if 'POINTS' in extra:
+        pts = '<points>'+''.join(['<point x="'+str(rand.randint(0,1900))+\
+            '" y="'+str(rand.randint(0,1000))+'" />' for p in \
+            range(points)])+'</points>'
+    return '<widget typeId="org.csstudio.opibuilder.widgets.'+typeId+\
+        '" version="1.0.0">\n'\
+        '<background_color><color red="'+str(rand.randint(0,255))+\
+        '" green="'+str(rand.randint(0,255))+'" blue="'+\
+        str(rand.randint(0,255))+'" /></background_color>\n'\
+        '<height>'+str(rand.randint(10,200))+'</height>\n'\
+        '<name>'+wType+' '+str(num)+'</name>\n'+\
+        extra.replace('NUM',str(num)).replace('POINTS',pts)+'\n'\
+        '<widget_type>'+wType+'</widget_type>\n'\
+        '<width>'+str(rand.randint(10,200))+'</width>\n'\
+        '<x>'+str(x)+'</x>\n<y>'+str(y)+'</y>\n</widget>\n'
+
+#Returns the text of a synthetic .opi screen with "count" widgets of every
+#supported type and "points" points per Polyline.
+def makeScreen(count,points,seed=0):
+    rand = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n'\
+        '<display typeId="org.csstudio.opibuilder.Display" version="1.0.0">\n'\
+        '<background_color><color red="240" green="240" blue="240" />'\
+        '</background_color>\n<height>1080</height>\n<name>Benchmark</name>\n'\
+        '<width>1920</width>\n']
+    for num in range(count):
+        for wType,typeId,extra in widgetKinds:
+            out.append(makeWidget(wType,typeId,extra,num,points,rand))
+    out.append('</display>\n')
+    return ''.join(out)
+
+#Calls func(*args) "number" times per round and returns the best time per
+#call in microseconds over "repeat" rounds.
+def timeCall(func,args,number,repeat):
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for n in range(number):
+            func(*args)
+        elapsed = (time.perf_counter()-start)/number*1e6
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+#Returns the commit of the working tree, or None outside a git checkout.
+def gitCommit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],\
+            cwd=os.path.dirname(os.path.abspath(__file__)),\
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+#Runs every benchmark and returns the results as a dict.
+def runBenchmarks(count,points,repeat):
+    screen = makeScreen(count,points)
+    widgets = list(opi2edl.readOpi(io.BytesIO(screen.encode('utf-8'))))[1:]
+    line = [w for w in widgets if w.wType == 'Polyline'][0]
+    rect = opi2edl.Widget('Rectangle',10,20,30,40,{})
+    colors = [w.get('background_color') for w in widgets]
+    nWidgets = len(widgets)
+
+    results = {}
+    results['returnProp_us'] = timeCall(opi2edl.returnProp,\
+        (line,'line_width'),10000,repeat)
+    # Every call matches a color that has not been seen before, then the
+    # same color again from the cache.
+    def matchNew():
+        opi2edl.colorMatches.clear()
+        for w in widgets:
+            opi2edl.convertColor(opi2edl.colorsList,w)
+    results['convertColor_uncached_us'] = timeCall(matchNew,(),1,repeat)/\
+        nWidgets
+    results['convertColor_cached_us'] = timeCall(opi2edl.convertColor,\
+        (opi2edl.colorsList,widgets[0]),10000,repeat)
+    def matchBatch():
+        opi2edl.colorMatches.clear()
+        opi2edl.nearestColors(colors)
+    results['nearestColors_batch_us'] = timeCall(matchBatch,(),1,repeat)/\
+        nWidgets
+    results['ptsGet_us'] = timeCall(opi2edl.ptsGet,(line,),1000,repeat)
+    results['edlPlaceWidget_us'] = timeCall(opi2edl.edlPlaceWidget,\
+        (rect,opi2edl.edlRectangleFmt,{'COLOR':'4','FILL':'fill\n'}),\
+        10000,repeat)
+
+    # End-to-end conversion of the whole screen from a cold color cache,
+    # console output discarded.
+    for name,module in [('opi2edl',opi2edl),('opi2edl_v2',opi2edl_v2)]:
+        def convert():
+            opi2edl.colorMatches.clear()
+            with redirect_stdout(io.StringIO()):
+                module.convertOpi(screen)
+        seconds = timeCall(convert,(),1,repeat)/1e6
+        results[name+'_screen_s'] = seconds
+        results[name+'_widgets_per_s'] = nWidgets/seconds
+
+    return {'commit':gitCommit(),'python':platform.python_version(),\
+        'numpy':opi2edl.loadNumpy() is not None,'widgetsPerType':count,\
+        'polylinePoints':points,'widgets':nWidgets,\
+        'screenBytes':len(screen.encode('utf-8')),'repeat':repeat,\
+        'results':results}
+
+
+###############################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n','--count',type=int,default=100,help='Number of \
+    widgets of each type in the synthetic screen.')
+    parser.add_argument('-p','--points',type=int,default=20,help='Number of \
+    points in each Polyline.')
+    parser.add_argument('-r','--repeat',type=int,default=5,help='Number of \
+    timing rounds; the best round is reported.')
+    parser.add_argument('-o','--output',help='JSON file to write results to. \
+    Results are printed if not given.')
+    parser.add_argument('--screen',help='Write the synthetic .opi screen to \
+    this file and exit.')
+    args = parser.parse_args()
+
+    if args.screen:
+        with open(args.screen,'w') as f:
+            f.write(makeScreen(args.count,args.points))
+        sys.exit(0)
+
+    report = runBenchmarks(args.count,args.points,args.repeat)
+    text = json.dumps(report,indent=1,sort_keys=True)
+    if args.output:
+        with open(args.output,'w') as f:
+            f.write(text+'\n')
+        print('Benchmark results written to "'+args.output+'".')
+    else:
+        print(text)
@@ -0,0 +1,230 @@
+#!/bin/env python
+'''
+Equivalence checks for the faster code paths in opi2edl.py and opi2edl_v2.py.
+
+Each check runs a fast path against the plain loop it replaced and reports
+any input the two disagree on:
+
+  colors   nearestColor and nearestColors (with and without NumPy) against
+           the original square-rooted palette distance loop, for random
+           colors plus every palette entry.
+  pairing  opi2edl_v2's grid-based nearestIndicator against the original
+           loop over every indicator, for randomized screen layouts.
+  mmap     readOpiMapped against readOpi, widget record by widget record,
+           and the EDL converted with and without --mmap, for generated
+           screens (with groups, comments and CDATA) and any .opi files
+           given on the command line.
+
+python opi2edl_check.py -c 200000 -l 2000 screens/*.opi
+
+Exits with status 1 if any check finds a difference.
+'''
+
+import io
+import os
+import sys
+import random
+import argparse
+import tempfile
+from math import sqrt
+from contextlib import redirect_stdout
+
+import opi2edl
+import opi2edl_v2
+from opi2edl_bench import makeScreen,makeWidget,widgetKinds
+
+# Number of differences printed for each check.
+shownDiffs = 5
+
+#Prints the result of a check and returns its number of differences.
+def report(name,checked,diffs):
+    print(name+': '+str(checked)+' checked, '+str(len(diffs))+' different')
+    for diff in diffs[:shownDiffs]:
+        print('    '+diff)
+    return len(diffs)
+
+### Palette matching.
+
+#The original palette match: square-rooted distance to every colorsList
+#entry, keeping the first closest.
+def oldNearestColor(rgb):
+    dMatch = 99999
+    match = 9999
+    for index,color in enumerate(opi2edl.colorsList):
+        r1,g1,b1 = color
+        r2,g2,b2 = rgb
+        d = sqrt((int(r2)-int(r1))**2 + (int(g2)-int(g1))**2 + \
+            (int(b2)-int(b1))**2)
+        if d < dMatch:
+            dMatch = d
+            match = index
+    return match
+
+#Checks nearestColor and nearestColors against oldNearestColor for "count"
+#random colors and every palette entry.
+def checkColors(count,seed):
+    rand = random.Random(seed)
+    colors = [tuple([int(c) for c in color]) for color in opi2edl.colorsList]
+    colors += [(rand.randint(0,255),rand.randint(0,255),rand.randint(0,255)) \
+        for n in range(count)]
+    expected = [oldNearestColor(c) for c in colors]
+
+    # Each path is matched from an empty cache. numpyModule set to False
+    # leaves NumPy out, so the pure Python paths are checked too.
+    saved = opi2edl.numpyModule
+    paths = [('nearestColor',False,lambda: [opi2edl.nearestColor(c) \
+        for c in colors]),\
+        ('nearestColors',False,lambda: opi2edl.nearestColors(colors))]
+    if opi2edl.loadNumpy() is not None:
+        paths.append(('nearestColors/numpy',opi2edl.numpyModule,\
+            lambda: opi2edl.nearestColors(colors)))
+    diffs = []
+    try:
+        for name,numpy,match in paths:
+            opi2edl.colorMatches.clear()
+            opi2edl.numpyModule = numpy
+            for rgb,old,new in zip(colors,expected,match()):
+                if old != new:
+                    diffs.append(name+' '+str(rgb)+': '+str(new)+\
+                        ', expected '+str(old))
+    finally:
+        opi2edl.numpyModule = saved
+        opi2edl.colorMatches.clear()
+    return report('colors',len(colors)*len(paths),diffs)
+
+### Unit label pairing.
+
+#The original pairing loop: the first indicator whose top-right corner is
+#closest to (x,y), or the last indicator if none is closer than 9999 px.
+def oldNearestIndicator(x,y,indicators):
+    dMin = [9999,-1]
+    for i,indic in enumerate(indicators):
+        dist = sqrt((x-(indic.x+indic.width))**2 + (y-indic.y)**2)
+        if dist < dMin[0]:
+            dMin = [dist,i]
+    return dMin[1] if dMin[1] >= 0 else len(indicators)-1
+
+#Returns a random screen layout: a list of indicators and a list of (x,y)
+#label positions. Small spreads give many ties and shared grid cells, large
+#ones labels beyond the 9999 px cut-off.
+def makeLayout(rand):
+    spread = rand.choice([20,500,2000,30000])
+    indicators = []
+    for n in range(rand.randint(1,80)):
+        if indicators and rand.random() < 0.1:
+            # Same top-right corner as an earlier indicator.
+            other = rand.choice(indicators)
+            indicators.append(opi2edl.Widget('Text Update',other.x,other.y,\
+                other.width,other.height,{}))
+        else:
+            indicators.append(opi2edl.Widget('Text Update',\
+                rand.randint(-spread,spread),rand.randint(-spread,spread),\
+                rand.randint(0,200),20,{}))
+    labels = [(rand.randint(-2*spread,2*spread),\
+        rand.randint(-2*spread,2*spread)) for n in range(rand.randint(1,40))]
+    return indicators,labels
+
+#Checks nearestIndicator against oldNearestIndicator for "count" random
+#layouts.
+def checkPairing(count,seed):
+    rand = random.Random(seed)
+    checked = 0
+    diffs = []
+    for layout in range(count):
+        indicators,labels = makeLayout(rand)
+        grid = opi2edl_v2.indicatorGrid(indicators)
+        for x,y in labels:
+            old = oldNearestIndicator(x,y,indicators)
+            new = opi2edl_v2.nearestIndicator(grid,x,y,indicators)
+            checked += 1
+            if old != new:
+                diffs.append('layout '+str(layout)+' label '+str((x,y))+\
+                    ': '+str(new)+', expected '+str(old))
+    return report('pairing',checked,diffs)
+
+### Memory-mapped reading.
+
+#Returns the text of a generated screen like makeScreen's, with some widgets
+#inside (nested) Grouping Containers and with comments and CDATA between and
+#inside widgets.
+def makeGroupedScreen(count,points,seed):
+    rand = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n'\
+        '<display typeId="org.csstudio.opibuilder.Display" version="1.0.0">\n'\
+        '<height>1080</height>\n<width>1920</width>\n']
+    for num in range(count):
+        depth = rand.choice([0,0,1,2])
+        for level in range(depth):
+            out.append('<widget typeId="org.csstudio.opibuilder.widgets.'\
+                'groupingContainer" version="1.0.0">\n'\
+                '<widget_type>Grouping Container</widget_type>\n'\
+                '<x>'+str(rand.randint(0,500))+'</x><y>'+\
+                str(rand.randint(0,500))+'</y>\n')
+        for wType,typeId,extra in widgetKinds:
+            out.append(makeWidget(wType,typeId,extra,num,points,rand))
+        out.append('<!-- <widget> in a comment -->\n')
+        out.append('</widget>\n'*depth)
+    out.append(makeWidget('Label','Label','<text><![CDATA[</widget>]]>'\
+        '</text>',count,points,rand))
+    out.append('</display>\n')
+    return ''.join(out)
+
+#Returns a widget record as a comparable tuple.
+def recordKey(widget):
+    return (widget.wType,widget.x,widget.y,widget.width,widget.height,\
+        widget.props)
+
+#Returns the EDL converted from the .opi file "path", written to "edl".
+def convertedEdl(path,edl,options):
+    with redirect_stdout(io.StringIO()):
+        opi2edl.convertPath(path,edl,options)
+    with open(edl,'rb') as f:
+        return f.read()
+
+#Checks readOpiMapped and --mmap conversion against the default reader for
+#generated screens and the .opi files in "paths".
+def checkMapped(count,points,seed,paths):
+    checked = 0
+    diffs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        screens = [('plain',makeScreen(count,points,seed)),\
+            ('grouped',makeGroupedScreen(count,points,seed))]
+        files = []
+        for name,text in screens:
+            path = os.path.join(tmp,name+'.opi')
+            with open(path,'w') as f:
+                f.write(text)
+            files.append(path)
+        for path in files+list(paths):
+            checked += 1
+            old = [recordKey(w) for w in opi2edl.readOpi(path)]
+            new = [recordKey(w) for w in opi2edl.readOpiMapped(path)]
+            if old != new:
+                diffs.append(path+': widget records differ')
+            edl = os.path.join(tmp,'check.edl')
+            if convertedEdl(path,edl,{}) != convertedEdl(path,edl,\
+                {'mmap':True}):
+                diffs.append(path+': EDL differs with --mmap')
+    return report('mmap',checked,diffs)
+
+
+###############################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('opi',nargs='*',help='.opi files to check the \
+    memory-mapped reader on, besides the generated screens.')
+    parser.add_argument('-c','--colors',type=int,default=200000,help='Number \
+    of random colors matched.')
+    parser.add_argument('-l','--layouts',type=int,default=2000,help='Number \
+    of random layouts paired.')
+    parser.add_argument('-n','--count',type=int,default=50,help='Number of \
+    widgets of each type in the generated screens.')
+    parser.add_argument('-p','--points',type=int,default=20,help='Number of \
+    points in each Polyline.')
+    parser.add_argument('-s','--seed',type=int,default=0,help='Random seed.')
+    args = parser.parse_args()
+
+    failed = checkColors(args.colors,args.seed)
+    failed += checkPairing(args.layouts,args.seed)
+    failed += checkMapped(args.count,args.points,args.seed,args.opi)
+    sys.exit(1 if failed else 0)